@@ -4,63 +4,353 @@ Enhanced PDF Filler V2 - Proper Text Wrapping Fix
 Using correct PyMuPDF insert_textbox syntax for reliable wrapping
 """
 import os
+import re
 import json
+import time
+import hashlib
 import fitz  # PyMuPDF
+from contextlib import contextmanager
 from datetime import datetime
 import logging
 
+from output_store import OutputStore, pdf_bytes
+
+# Mapping file locations, searched in order
+MAPPING_PATHS = [
+    r"C:\mcp-servers\pharmacare-form\macs_form_mapping_v3.json",
+    r"C:\forms\macs_form_mapping_v3_updated.json",
+    r"C:\forms\macs_form_mapping_v3.json",
+    "macs_form_mapping_v3_updated.json",
+    "macs_form_mapping_v3.json"
+]
+
+# Maximum characters accepted per field; anything not listed uses the default
+FIELD_MAX_LENGTHS = {
+    "symptoms": 2000,
+    "medication": 2000,
+    "medical_history": 2000,
+    "diagnosis": 500,
+}
+DEFAULT_FIELD_MAX_LENGTH = 200
+# Fields clients may send (see PHARMACARE_FORM_INSTRUCTIONS.txt) that are
+# accepted and stored but have no place on the form unless the mapping adds one
+EXTRA_FIELDS = frozenset({"medical_history", "doctor_name"})
+MAX_CONDITION_NUMBERS = 50
+# Bump whenever a change to layout or drawing alters the rendered bytes
+RENDER_VERSION = 1
+
+
+class ValidationError(ValueError):
+    """Raised when request parameters are rejected before any PDF work"""
+
+
+class DeadlineExceeded(TimeoutError):
+    """Raised when a fill runs past its request deadline"""
+
+
+def load_mapping():
+    """Load the field mapping from the first location that exists"""
+    logger = logging.getLogger(__name__)
+    for path in MAPPING_PATHS:
+        if os.path.exists(path):
+            logger.info(f"Loading mapping from: {path}")
+            with open(path, 'r') as f:
+                return json.load(f)
+    raise FileNotFoundError("No mapping file found in any of the expected locations")
+
+
+def render_version():
+    """Identifies the code a form is rendered with: RENDER_VERSION and the PyMuPDF build
+
+    Stored overlay records only pin the template and mapping, so their
+    rendered bytes change whenever this does.
+    """
+    return f"{RENDER_VERSION}-{fitz.VersionBind}"
+
+
+# Documents opened through open_document() and not yet closed
+_open_documents = 0
+
+
+@contextmanager
+def open_document(source):
+    """Open a PDF (path or bytes) and guarantee it is closed, even if filling fails"""
+    global _open_documents
+    if isinstance(source, bytes):
+        doc = fitz.open(stream=source, filetype="pdf")
+    else:
+        doc = fitz.open(source)
+    _open_documents += 1
+    try:
+        yield doc
+    finally:
+        doc.close()
+        _open_documents -= 1
+
+
+def open_document_count():
+    """Number of documents currently open in this process"""
+    return _open_documents
+
+
+def check_deadline(deadline):
+    """Abort if the monotonic deadline has passed"""
+    if deadline is not None and time.monotonic() > deadline:
+        raise DeadlineExceeded("Request deadline exceeded")
+
+
+# Fonts are loaded once per process and reused for every fill
+FALLBACK_FONT = "cjk"  # Droid Sans Fallback, built into MuPDF
+_fonts = {}
+_font_codepoints = {}
+
+
+def get_font(name):
+    """Cached fitz.Font for a built-in font name"""
+    font = _fonts.get(name)
+    if font is None:
+        font = _fonts[name] = fitz.Font(name)
+        _font_codepoints[name] = frozenset(font.valid_codepoints())
+    return font
+
+
+def font_for(text):
+    """Helvetica when it covers every character, otherwise the fallback font"""
+    font = get_font("helv")
+    if {ord(c) for c in text if c.isprintable()} <= _font_codepoints["helv"]:
+        return font
+    return get_font(FALLBACK_FONT)
+
+
+# Kept off the available width so fill_textbox never re-wraps a line we broke
+LAYOUT_SLACK = 0.01
+
+
+class TextLayout:
+    """Line breaking for one text, reusable across font sizes and boxes
+
+    Breaks lines the way TextWriter.fill_textbox does, but each word is
+    measured once at size 1 and scaled, and every line is found in one
+    greedy pass instead of fill_textbox's search back from the last word.
+    """
+
+    def __init__(self, text, font):
+        self.font = font
+        self.space = font.text_length(" ", fontsize=1)
+        self.paragraphs = []
+        widths = {}
+        for line in text.splitlines():
+            words = line.split(" ")
+            for word in words:
+                if word not in widths:
+                    widths[word] = font.text_length(word, fontsize=1)
+            self.paragraphs.append((line, words, [widths[word] for word in words]))
+
+    def box(self, rect, fontsize):
+        """(line width, number of lines) available in rect, as fill_textbox computes them"""
+        ascender, descender = self.font.ascender, self.font.descender
+        line_height = fontsize * (ascender - descender if ascender - descender > 1 else 1.2)
+        first_baseline = rect.y0 + fontsize * ascender
+        max_lines = int((rect.y1 - first_baseline) / line_height) + 1
+        return rect.width - fontsize * 0.2 - LAYOUT_SLACK, max_lines
+
+    def lines(self, width, fontsize):
+        """The text broken into lines no wider than width"""
+        space = self.space * fontsize
+        lines = []
+        for line, words, widths in self.paragraphs:
+            if line in ("", " ") or (sum(widths) + self.space * (len(words) - 1)) * fontsize <= width:
+                lines.append(line)
+                continue
+            current, current_width = [], 0.0
+            for word, word_width in zip(words, widths):
+                word_width *= fontsize
+                pieces = ([(word, word_width)] if word_width <= width
+                          else self._split_word(word, width, fontsize))
+                for piece, piece_width in pieces:
+                    if current and current_width + space + piece_width > width:
+                        lines.append(" ".join(current))
+                        current, current_width = [piece], piece_width
+                    elif current:
+                        current.append(piece)
+                        current_width += space + piece_width
+                    else:
+                        current, current_width = [piece], piece_width
+            if current:
+                lines.append(" ".join(current))
+        return lines
+
+    def _split_word(self, word, width, fontsize):
+        """Cut a word wider than the box into pieces that fit"""
+        pieces = []
+        piece, piece_width = "", 0.0
+        for char, char_width in zip(word, self.font.char_lengths(word, fontsize=fontsize)):
+            if piece and piece_width + char_width > width:
+                pieces.append((piece, piece_width))
+                piece, piece_width = "", 0.0
+            piece += char
+            piece_width += char_width
+        if piece:
+            pieces.append((piece, piece_width))
+        return pieces
+
+
+class PageEmitter:
+    """Collects a document's text and checkmark strokes and writes them once per page
+
+    Each page gets one TextWriter and one Shape, so a fill adds a single
+    text block and a single path to each page's content stream.
+    """
+    CHECK_COLOR = (1, 0, 0)
+    CHECK_WIDTH = 3
+
+    def __init__(self, doc):
+        self.doc = doc
+        self.writers = {}
+        self.shapes = {}
+
+    def writer(self, page_num):
+        if page_num not in self.writers:
+            self.writers[page_num] = fitz.TextWriter(self.doc[page_num].rect)
+        return self.writers[page_num]
+
+    def shape(self, page_num):
+        if page_num not in self.shapes:
+            self.shapes[page_num] = self.doc[page_num].new_shape()
+        return self.shapes[page_num]
+
+    def commit(self):
+        for page_num, writer in self.writers.items():
+            writer.write_text(self.doc[page_num])
+        for shape in self.shapes.values():
+            shape.finish(color=self.CHECK_COLOR, width=self.CHECK_WIDTH, closePath=False)
+            shape.commit()
+
+
+class ParamValidator:
+    """Validates fill parameters against the mapping before any PDF work
+
+    Built once from the mapping so each request only does set lookups,
+    length checks and one precompiled regex match.
+    """
+    _CONDITION_STRING = re.compile(r"^[\d\s,]*$")
+
+    def __init__(self, mapping):
+        self.text_fields = frozenset(mapping.get('fields', {}))
+        self.allowed_fields = self.text_fields | EXTRA_FIELDS | {'condition_numbers', 'date'}
+        self.condition_numbers = frozenset(
+            box['number'] for box in mapping.get('condition_boxes', [])
+        )
+        self.max_lengths = {
+            name: FIELD_MAX_LENGTHS.get(name, DEFAULT_FIELD_MAX_LENGTH)
+            for name in self.allowed_fields
+        }
+
+    def validate(self, params):
+        """Return a cleaned copy of params or raise ValidationError"""
+        if not isinstance(params, dict):
+            raise ValidationError("params must be an object")
+
+        unknown = set(params) - self.allowed_fields
+        if unknown:
+            raise ValidationError(f"Unknown fields: {', '.join(sorted(unknown))}")
+
+        cleaned = {}
+        for name, value in params.items():
+            if name == 'condition_numbers':
+                cleaned[name] = self._validate_conditions(value)
+                continue
+            if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+                raise ValidationError(f"Field {name} must be a string")
+            value = str(value)
+            if len(value) > self.max_lengths[name]:
+                raise ValidationError(
+                    f"Field {name} exceeds {self.max_lengths[name]} characters"
+                )
+            cleaned[name] = value
+        return cleaned
+
+    def _validate_conditions(self, value):
+        """Normalize condition_numbers to a list of known box numbers"""
+        if isinstance(value, bool):
+            raise ValidationError("condition_numbers must be numbers")
+        if isinstance(value, int):
+            numbers = [value]
+        elif isinstance(value, str):
+            if len(value) > 4 * MAX_CONDITION_NUMBERS or not self._CONDITION_STRING.match(value):
+                raise ValidationError("condition_numbers string must look like '1,3,5'")
+            numbers = [int(x) for x in value.replace(',', ' ').split()]
+        elif isinstance(value, list):
+            if not all(isinstance(x, int) and not isinstance(x, bool) for x in value):
+                raise ValidationError("condition_numbers must be a list of integers")
+            numbers = value
+        else:
+            raise ValidationError("condition_numbers must be a list of integers")
+
+        if len(numbers) > MAX_CONDITION_NUMBERS:
+            raise ValidationError(f"At most {MAX_CONDITION_NUMBERS} condition numbers allowed")
+        invalid = [n for n in numbers if n not in self.condition_numbers]
+        if invalid:
+            raise ValidationError(f"Unknown condition numbers: {invalid}")
+        return list(numbers)
+
+
 class EnhancedPDFFiller:
-    def __init__(self):
+    def __init__(self, mapping=None, store=None):
         # Setup logging
         logging.basicConfig(
             level=logging.INFO,
             format='%(asctime)s - %(levelname)s - %(message)s'
         )
         self.logger = logging.getLogger(__name__)
-        
-        # Try to find mapping file
-        mapping_paths = [
-            r"C:\mcp-servers\pharmacare-form\macs_form_mapping_v3.json",
-            r"C:\forms\macs_form_mapping_v3_updated.json",
-            r"C:\forms\macs_form_mapping_v3.json",
-            "macs_form_mapping_v3_updated.json",
-            "macs_form_mapping_v3.json"
+        self.mapping = mapping or load_mapping()
+        self.store = store or OutputStore()
+        self._template_bytes = None
+        self._template_version = None
+        # Set to a dict to collect seconds spent per field (profiling only)
+        self.field_timings = None
+    
+    def template_path(self):
+        """Locate the blank template PDF named in the mapping"""
+        pdf_filename = self.mapping.get('pdf_file', 'blank.pdf')
+        pdf_paths = [
+            os.path.join(r"C:\mcp-servers\pharmacare-form", pdf_filename),
+            os.path.join(r"C:\forms", pdf_filename),
+            pdf_filename
         ]
         
-        self.mapping = None
-        for path in mapping_paths:
+        for path in pdf_paths:
             if os.path.exists(path):
-                self.logger.info(f"Loading mapping from: {path}")
-                with open(path, 'r') as f:
-                    self.mapping = json.load(f)
-                break
+                return path
         
-        if not self.mapping:
-            raise FileNotFoundError("No mapping file found in any of the expected locations")
+        raise FileNotFoundError(f"PDF file {pdf_filename} not found")
     
-    def fill_form(self, data):
-        """Fill the PDF form with provided data"""
-        try:
-            # Determine PDF path
-            pdf_filename = self.mapping.get('pdf_file', 'blank.pdf')
-            pdf_paths = [
-                os.path.join(r"C:\mcp-servers\pharmacare-form", pdf_filename),
-                os.path.join(r"C:\forms", pdf_filename),
-                pdf_filename
-            ]
-            
-            pdf_path = None
-            for path in pdf_paths:
-                if os.path.exists(path):
-                    pdf_path = path
-                    break
-            
-            if not pdf_path:
-                raise FileNotFoundError(f"PDF file {pdf_filename} not found")
-            
-            self.logger.info(f"Opening PDF: {pdf_path}")
-            doc = fitz.open(pdf_path)
-            
+    def template_bytes(self):
+        """Template PDF contents, read once per filler"""
+        if self._template_bytes is None:
+            pdf_path = self.template_path()
+            self.logger.info(f"Loading template from: {pdf_path}")
+            with open(pdf_path, 'rb') as f:
+                self._template_bytes = f.read()
+        return self._template_bytes
+    
+    def template_version(self):
+        """Hash of the template bytes and mapping; a fill is reproducible from it"""
+        if self._template_version is None:
+            digest = hashlib.sha256(self.template_bytes())
+            digest.update(json.dumps(self.mapping, sort_keys=True).encode('utf-8'))
+            self._template_version = digest.hexdigest()[:16]
+        return self._template_version
+    
+    @contextmanager
+    def render(self, data, deadline=None, template_path=None):
+        """Yield the template with data filled in; the document is closed afterwards
+
+        Output depends only on data, the template and the mapping, so a
+        stored overlay record can be rendered again later.
+        """
+        check_deadline(deadline)
+        with open_document(template_path or self.template_bytes()) as doc:
             # Handle condition boxes first
             condition_numbers = data.get('condition_numbers', [])
             if isinstance(condition_numbers, int):
@@ -69,47 +359,84 @@ class EnhancedPDFFiller:
                 # Parse string like "1,3,5" or "1 3 5"
                 condition_numbers = [int(x.strip()) for x in condition_numbers.replace(',', ' ').split() if x.strip().isdigit()]
             
+            # Text and checkmarks are collected per page and written once
+            emitter = PageEmitter(doc)
+            
             # Highlight condition boxes
-            for page_num in range(len(doc)):
-                page = doc[page_num]
-                for box_num in condition_numbers:
-                    self._highlight_condition_box(page, box_num)
+            for box_num in condition_numbers:
+                self._highlight_condition_box(emitter, box_num)
             
             # Process each field
             for field_name, field_data in data.items():
                 if field_name in self.mapping['fields']:
-                    self._fill_field(doc, field_name, field_data)
-            
-            # Save output
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            
-            # Create output directory if needed
-            output_dir = r"C:\forms"
-            os.makedirs(output_dir, exist_ok=True)
+                    check_deadline(deadline)
+                    if self.field_timings is None:
+                        self._fill_field(emitter, field_name, field_data)
+                    else:
+                        started = time.perf_counter()
+                        self._fill_field(emitter, field_name, field_data)
+                        self.field_timings[field_name] = (
+                            self.field_timings.get(field_name, 0.0)
+                            + time.perf_counter() - started
+                        )
             
-            # Generate filename with full patient name
+            emitter.commit()
+            check_deadline(deadline)
+            yield doc
+    
+    def warm_up(self):
+        """Load template, mapping and fonts and render one throwaway fill
+
+        Returns the seconds taken, so callers can report startup time.
+        """
+        started = time.perf_counter()
+        self.template_version()
+        get_font("helv")
+        get_font(FALLBACK_FONT)
+        sample = {name: "Warm up" for name in self.mapping['fields']}
+        sample['condition_numbers'] = [
+            box['number'] for box in self.mapping.get('condition_boxes', [])[:1]
+        ]
+        with self.render(sample) as doc:
+            pdf_bytes(doc)
+        return time.perf_counter() - started
+    
+    def fill_form(self, data, deadline=None):
+        """Fill the PDF form with provided data and return its store record
+
+        deadline is an optional time.monotonic() value; work stops with
+        DeadlineExceeded once it has passed. In overlay storage mode only
+        the data and template version are stored, and nothing is rendered.
+        """
+        try:
             patient_name = data.get('patient_name', 'Unknown')
-            safe_patient_name = patient_name.replace(' ', '_').replace(',', '')
-            output_filename = f"{safe_patient_name}_{timestamp}.pdf"
-            output_path = os.path.join(output_dir, output_filename)
-            
-            doc.save(output_path)
-            doc.close()
+            if self.store.mode == 'overlay':
+                check_deadline(deadline)
+                record = self.store.save_overlay(
+                    data, patient_name, self.template_version(),
+                    self.template_path(), self.mapping
+                )
+            else:
+                with self.render(data, deadline) as doc:
+                    # Save output into the patient's shard of the store
+                    record = self.store.save(doc, patient_name)
             
-            self.logger.info(f"Form saved to: {output_path}")
-            return output_path
+            self.logger.info(f"Form saved to: {self.store.full_path(record)}")
+            return record
             
         except Exception as e:
             self.logger.error(f"Error filling form: {str(e)}")
             raise
     
-    def _fill_field(self, doc, field_name, value):
+    def _fill_field(self, emitter, field_name, value):
         """Fill a specific field with proper text wrapping"""
         field_coords = self.mapping['fields'].get(field_name, [])
+        text = str(value)
+        font = font_for(text)
+        layout = TextLayout(text, font)
         
         for coord in field_coords:
-            page_num = coord['page']
-            page = doc[page_num]
+            writer = emitter.writer(coord['page'])
             
             # Create rectangle from coordinates
             rect = fitz.Rect(coord['x1'], coord['y1'], coord['x2'], coord['y2'])
@@ -118,106 +445,99 @@ class EnhancedPDFFiller:
             if field_name == "symptoms":
                 # For symptoms field - smaller font, tighter spacing
                 fontsize = 6
-                # Try to insert text with automatic wrapping
-                rc = page.insert_textbox(
-                    rect,
-                    str(value),
-                    fontname="helv",
-                    fontsize=fontsize,
-                    align=fitz.TEXT_ALIGN_LEFT
-                )
+                width, max_lines = layout.box(rect, fontsize)
+                lines = layout.lines(width, fontsize)
                 
                 # If text doesn't fit, try progressively smaller font sizes
-                while rc < 0 and fontsize > 4:
+                while len(lines) > max_lines and fontsize > 4:
                     fontsize -= 0.5
-                    rc = page.insert_textbox(
-                        rect,
-                        str(value),
-                        fontname="helv",
-                        fontsize=fontsize,
-                        align=fitz.TEXT_ALIGN_LEFT
-                    )
+                    width, max_lines = layout.box(rect, fontsize)
+                    lines = layout.lines(width, fontsize)
                 
-                if rc < 0:
-                    # If still doesn't fit, truncate and add ellipsis
-                    truncated = self._truncate_text(str(value), rect, page, fontsize)
-                    page.insert_textbox(
-                        rect,
-                        truncated,
-                        fontname="helv",
-                        fontsize=fontsize,
-                        align=fitz.TEXT_ALIGN_LEFT
-                    )
+                if len(lines) > max_lines:
+                    # If still doesn't fit, cut after the last line that fits and add ellipsis
+                    lines = self._truncate_lines(lines, max_lines, width, font, fontsize)
                     self.logger.warning(f"Text truncated for field {field_name}")
+                self._write_lines(writer, rect, lines, font, fontsize)
+                continue
                     
             elif field_name in ["date", "doctor_name", "patient_name"]:
                 # Regular fields - normal font size
-                page.insert_textbox(
-                    rect,
-                    str(value),
-                    fontname="helv",
-                    fontsize=10,
-                    align=fitz.TEXT_ALIGN_LEFT
-                )
+                fontsize = 10
             else:
                 # Default handling
-                page.insert_textbox(
-                    rect,
-                    str(value),
-                    fontname="helv",
-                    fontsize=8,
-                    align=fitz.TEXT_ALIGN_LEFT
-                )
+                fontsize = 8
+            
+            width, max_lines = layout.box(rect, fontsize)
+            lines = layout.lines(width, fontsize)
+            if len(lines) <= max_lines:
+                self._write_lines(writer, rect, lines, font, fontsize)
+            else:
+                self.logger.warning(f"Text does not fit field {field_name}")
+    
+    def _write_lines(self, writer, rect, lines, font, fontsize):
+        """Write already broken lines into writer"""
+        writer.fill_textbox(
+            rect,
+            "\n".join(lines),
+            font=font,
+            fontsize=fontsize,
+            align=fitz.TEXT_ALIGN_LEFT,
+            warn=None
+        )
     
-    def _truncate_text(self, text, rect, page, fontsize):
-        """Truncate text to fit within rectangle"""
-        # Try progressively shorter text until it fits
-        truncated = text
-        while len(truncated) > 10:
-            test_text = truncated[:-10] + "..."
-            rc = page.insert_textbox(
-                rect,
-                test_text,
-                fontname="helv",
-                fontsize=fontsize,
-                align=fitz.TEXT_ALIGN_LEFT
-            )
-            if rc >= 0:
-                return test_text
-            truncated = truncated[:-10]
-        return truncated[:10] + "..."
+    def _truncate_lines(self, lines, max_lines, width, font, fontsize):
+        """Keep the lines that fit, ending the last with as much text as fits before an ellipsis"""
+        # Only the last line changes, so only its text and the next line's are tried
+        last = f"{lines[max_lines - 1]} {lines[max_lines]}"
+        while last and font.text_length(last.rstrip() + "...", fontsize=fontsize) > width:
+            last = last[:-1]
+        return lines[:max_lines - 1] + [last.rstrip() + "..."]
     
-    def _highlight_condition_box(self, page, box_number):
+    def _highlight_condition_box(self, emitter, box_number):
         """Highlight a specific condition box by number"""
         for box in self.mapping.get('condition_boxes', []):
             if box['number'] == box_number:
                 # Draw a red checkmark in the box
+                shape = emitter.shape(box.get('page', 0))
                 check_x = box['x1'] + 5
                 check_y = box['y1'] + 20
                 
                 # First stroke of checkmark
-                page.draw_line(
+                shape.draw_line(
                     fitz.Point(check_x, check_y),
-                    fitz.Point(check_x + 15, check_y + 15),
-                    color=(1, 0, 0),
-                    width=3
+                    fitz.Point(check_x + 15, check_y + 15)
                 )
                 
                 # Second stroke of checkmark
-                page.draw_line(
+                shape.draw_line(
                     fitz.Point(check_x + 15, check_y + 15),
-                    fitz.Point(check_x + 35, check_y - 20),
-                    color=(1, 0, 0),
-                    width=3
+                    fitz.Point(check_x + 35, check_y - 20)
                 )
                 
                 return True
         return False
 
-def handle_pdf_request(data):
-    """Handle incoming PDF fill request"""
+# One filler per process, so mapping, template and fonts load only once
+_filler = None
+
+
+def get_filler():
+    """The process-wide filler, created on first use"""
+    global _filler
+    if _filler is None:
+        _filler = EnhancedPDFFiller()
+    return _filler
+
+
+def handle_pdf_request(data, deadline=None):
+    """Handle incoming PDF fill request
+
+    DeadlineExceeded is re-raised so callers can report a timeout
+    rather than an ordinary fill failure.
+    """
     try:
-        filler = EnhancedPDFFiller()
+        filler = get_filler()
         
         # Extract form data
         form_data = {}
@@ -236,14 +556,19 @@ def handle_pdf_request(data):
                 form_data[key] = value
         
         # Fill the form
-        output_path = filler.fill_form(form_data)
+        record = filler.fill_form(form_data, deadline=deadline)
         
-        return {
+        result = {
             "success": True,
             "message": "Form filled successfully",
-            "output_path": output_path
+            "output_id": record['id']
         }
+        if record['kind'] == 'pdf':
+            result["output_path"] = filler.store.full_path(record)
+        return result
         
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         logging.error(f"Error in handle_pdf_request: {str(e)}")
         return {
@@ -173,14 +173,21 @@ Condition Mode:
         
         if file_path:
             try:
-                self.pdf_path = file_path
-                self.pdf_doc = fitz.open(file_path)
-                self.current_page = 0
+                self.open_pdf(file_path)
                 self.display_page()
                 self.status_var.set(f"Loaded: {os.path.basename(file_path)}")
             except Exception as e:
                 messagebox.showerror("Error", f"Failed to load PDF: {str(e)}")
     
+    def open_pdf(self, pdf_path):
+        """Open a PDF, closing the previously loaded one"""
+        doc = fitz.open(pdf_path)
+        if self.pdf_doc:
+            self.pdf_doc.close()
+        self.pdf_path = pdf_path
+        self.pdf_doc = doc
+        self.current_page = 0
+    
     def display_page(self):
         """Display current page of PDF"""
         if not self.pdf_doc:
@@ -195,6 +202,7 @@ Condition Mode:
         
         # Convert to PIL Image
         img_data = pix.tobytes("ppm")
+        pix = None  # Release the MuPDF pixmap before building the image
         import io
         img = Image.open(io.BytesIO(img_data))
         
@@ -541,9 +549,7 @@ Condition Mode:
                     
                     for pdf_path in possible_paths:
                         if os.path.exists(pdf_path):
-                            self.pdf_path = pdf_path
-                            self.pdf_doc = fitz.open(pdf_path)
-                            self.current_page = 0
+                            self.open_pdf(pdf_path)
                             self.display_page()
                             break
                     else:
@@ -556,7 +562,11 @@ Condition Mode:
     
     def run(self):
         """Run the application"""
-        self.root.mainloop()
+        try:
+            self.root.mainloop()
+        finally:
+            if self.pdf_doc:
+                self.pdf_doc.close()
 
 if __name__ == "__main__":
     app = FormFieldMapperV3()
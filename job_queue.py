@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+Durable Job Queue for Asynchronous Form Fills
+Jobs are kept in a local SQLite database, so queued work survives a
+server restart. Runner threads claim the highest-priority job that is
+due, run it, and either store the result or schedule a retry with
+exponential backoff until its attempts are used up.
+"""
+
+import os
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+
+from enhanced_pdf_filler_v2 import DeadlineExceeded
+from worker_pool import WorkerUnavailable
+
+DEFAULT_JOB_DB = os.environ.get(
+    'PHARMACARE_JOB_DB',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'jobs.sqlite3')
+)
+DEFAULT_MAX_ATTEMPTS = 3
+RETRY_BASE_SECONDS = 5.0
+JOB_TIMEOUT_SECONDS = 120.0
+# Finished jobs older than this are purged when the queue opens
+JOB_RETENTION_DAYS = 30
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    priority INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    params TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    result TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    run_after REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_due ON jobs (status, priority DESC, created);
+"""
+
+
+class JobQueue:
+    """SQLite-backed queue of fill jobs
+
+    Status moves queued -> running -> done, or back to queued for a retry,
+    or to failed once attempts run out.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or DEFAULT_JOB_DB
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(_SCHEMA)
+        # Work other threads can pick up was added or became due
+        self.wakeup = threading.Event()
+
+    def recover(self):
+        """Requeue jobs interrupted by a restart and purge old finished jobs"""
+        cutoff = time.time() - JOB_RETENTION_DAYS * 86400
+        with self.lock:
+            requeued = self.db.execute(
+                "UPDATE jobs SET status = 'queued', updated = ? WHERE status = 'running'",
+                (time.time(),)
+            ).rowcount
+            self.db.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated < ?",
+                (cutoff,)
+            )
+        return requeued
+
+    def submit(self, params, priority=0, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        """Queue a fill and return its job id"""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO jobs (id, priority, status, params, max_attempts, "
+                "created, updated, run_after) VALUES (?, ?, 'queued', ?, ?, ?, ?, ?)",
+                (job_id, priority, json.dumps(params), max_attempts, now, now, now)
+            )
+        self.wakeup.set()
+        return job_id
+
+    def claim(self):
+        """Mark the next due job running and return (id, params), or None"""
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.db.execute(
+                    "SELECT id, params FROM jobs WHERE status = 'queued' AND run_after <= ? "
+                    "ORDER BY priority DESC, created LIMIT 1",
+                    (now,)
+                ).fetchone()
+                if row is not None:
+                    self.db.execute(
+                        "UPDATE jobs SET status = 'running', attempts = attempts + 1, "
+                        "updated = ? WHERE id = ?",
+                        (now, row['id'])
+                    )
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        return row['id'], json.loads(row['params'])
+
+    def complete(self, job_id, result):
+        with self.lock:
+            self.db.execute(
+                "UPDATE jobs SET status = 'done', result = ?, error = NULL, updated = ? "
+                "WHERE id = ?",
+                (json.dumps(result), time.time(), job_id)
+            )
+
+    def fail(self, job_id, error):
+        """Record a failed attempt; retry later unless attempts are used up"""
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(
+                "SELECT attempts, max_attempts FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            if row['attempts'] < row['max_attempts']:
+                delay = RETRY_BASE_SECONDS * 2 ** (row['attempts'] - 1)
+                self.db.execute(
+                    "UPDATE jobs SET status = 'queued', error = ?, updated = ?, run_after = ? "
+                    "WHERE id = ?",
+                    (error, now, now + delay, job_id)
+                )
+            else:
+                self.db.execute(
+                    "UPDATE jobs SET status = 'failed', error = ?, updated = ? WHERE id = ?",
+                    (error, now, job_id)
+                )
+
+    def release(self, job_id):
+        """Put a claimed job back in the queue without using up an attempt"""
+        with self.lock:
+            self.db.execute(
+                "UPDATE jobs SET status = 'queued', attempts = attempts - 1, updated = ? "
+                "WHERE id = ?",
+                (time.time(), job_id)
+            )
+
+    def status(self, job_id, with_result=False):
+        """Job details as a dict, or None if the id is unknown"""
+        with self.lock:
+            row = self.db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        info = {
+            "job_id": row['id'],
+            "status": row['status'],
+            "priority": row['priority'],
+            "attempts": row['attempts'],
+            "max_attempts": row['max_attempts'],
+            "created": row['created'],
+            "updated": row['updated'],
+        }
+        if row['error']:
+            info["error"] = row['error']
+        if with_result and row['result']:
+            info["result"] = json.loads(row['result'])
+        return info
+
+    def counts(self):
+        """Number of jobs in each status"""
+        with self.lock:
+            rows = self.db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class JobRunner:
+    """Threads that pull jobs from the queue and run them with run_fill
+
+    run_fill(params, deadline) must return the fill result dict or raise;
+    WorkerUnavailable puts the job back without counting the attempt.
+    """
+    POLL_SECONDS = 1.0
+
+    def __init__(self, jobs, run_fill, threads=2):
+        self.jobs = jobs
+        self.run_fill = run_fill
+        self.threads = [
+            threading.Thread(target=self._loop, name=f"job-runner-{i}", daemon=True)
+            for i in range(threads)
+        ]
+        self.stopping = threading.Event()
+        self.logger = logging.getLogger(__name__)
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self, timeout=None):
+        """Stop claiming jobs; jobs already running are allowed to finish"""
+        self.stopping.set()
+        self.jobs.wakeup.set()
+        for thread in self.threads:
+            if thread.ident is not None:
+                thread.join(timeout)
+
+    def _loop(self):
+        while not self.stopping.is_set():
+            job = self.jobs.claim()
+            if job is None:
+                # Sleep until new work arrives or a retry may have become due
+                self.jobs.wakeup.wait(self.POLL_SECONDS)
+                self.jobs.wakeup.clear()
+                continue
+            job_id, params = job
+            try:
+                result = self.run_fill(params, time.monotonic() + JOB_TIMEOUT_SECONDS)
+            except WorkerUnavailable:
+                # Never reached a worker (busy with synchronous fills), so
+                # it is not a failed attempt; wait for a free one again
+                self.jobs.release(job_id)
+            except DeadlineExceeded as e:
+                self.jobs.fail(job_id, f"Timed out: {e}")
+            except Exception as e:
+                self.logger.error(f"Job {job_id} failed: {e}")
+                self.jobs.fail(job_id, str(e))
+            else:
+                if result.get('success'):
+                    self.jobs.complete(job_id, result)
+                else:
+                    self.jobs.fail(job_id, result.get('error', 'Fill failed'))
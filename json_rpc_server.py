@@ -4,70 +4,657 @@ Simple JSON-RPC Server for PDF Form Filling
 This server can be called by OpenRPC MCP
 """
 
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from http import HTTPStatus
+import http.client
 import json
 import sys
 import os
+import io
+import time
+import hmac
+import pstats
+import signal
+import asyncio
+import logging
+import argparse
+import threading
+import unicodedata
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from email.utils import formatdate, parsedate_to_datetime
 
 # Add current directory to path
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-from enhanced_pdf_filler_v2 import handle_pdf_request
+from enhanced_pdf_filler_v2 import (
+    load_mapping, ParamValidator, ValidationError, DeadlineExceeded, render_version
+)
+from worker_pool import WorkerPool, RequestCancelled, current_rss
+from job_queue import JobQueue, JobRunner
+from output_store import OutputStore
 
-class JSONRPCHandler(BaseHTTPRequestHandler):
-    def do_POST(self):
-        # Read the request
-        content_length = int(self.headers['Content-Length'])
-        post_data = self.rfile.read(content_length)
-        
+# Admission limits
+MAX_BODY_BYTES = 64 * 1024
+MAX_BATCH_SIZE = 20
+DEFAULT_TIMEOUT = 30.0  # seconds, used when the client sends no X-Request-Timeout
+MAX_TIMEOUT = 120.0
+
+# JSON-RPC error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+REQUEST_TIMEOUT = -32001
+SERVER_NOT_READY = -32002
+UNAUTHORIZED = -32003
+
+# Admin methods are only enabled when this token is set, and callers
+# must send it in the X-Admin-Token header
+ADMIN_TOKEN = os.environ.get('PHARMACARE_ADMIN_TOKEN')
+ADMIN_METHODS = {'startProfiling', 'stopProfiling', 'getProfilingReport'}
+PROFILE_DIR = os.environ.get(
+    'PHARMACARE_PROFILE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles')
+)
+
+# Built once at startup
+validator = None
+pool = None
+jobs = None
+store = OutputStore()
+ready = threading.Event()
+startup_seconds = None
+
+
+def error_response(code, message, request_id=None):
+    """Build a JSON-RPC error response"""
+    return {
+        "jsonrpc": "2.0",
+        "error": {
+            "code": code,
+            "message": message
+        },
+        "id": request_id
+    }
+
+
+def request_deadline(header_value, received=None):
+    """Turn an X-Request-Timeout header (seconds) into a monotonic deadline
+
+    received is the monotonic time the request arrived, now by default.
+    """
+    timeout = DEFAULT_TIMEOUT
+    if header_value:
         try:
-            # Parse JSON-RPC request
-            request = json.loads(post_data.decode('utf-8'))
-            
-            # Log the request
-            print(f"Received request: {json.dumps(request, indent=2)}", file=sys.stderr)
+            timeout = float(header_value)
+        except ValueError:
+            raise ValidationError("X-Request-Timeout must be a number of seconds")
+        if not 0 < timeout <= MAX_TIMEOUT:
+            raise ValidationError(f"X-Request-Timeout must be between 0 and {MAX_TIMEOUT}")
+    return (received if received is not None else time.monotonic()) + timeout
+
+
+def _request_id(request):
+    return request.get('id') if isinstance(request, dict) else None
+
+
+def is_admin(headers):
+    """True if the request carries the configured admin token"""
+    token = headers.get('X-Admin-Token')
+    return bool(ADMIN_TOKEN and token and hmac.compare_digest(token, ADMIN_TOKEN))
+
+
+def handle_rpc(request, deadline, admin=False, cancelled=None):
+    """Dispatch a single JSON-RPC request object and return its response
+
+    cancelled is an optional threading.Event set when the client has gone
+    away; a fill still waiting for a worker then raises RequestCancelled.
+    """
+    if not isinstance(request, dict):
+        return error_response(INVALID_REQUEST, "Invalid request")
+    
+    method = request.get('method')
+    try:
+        # Log the request
+        print(f"Received request: {json.dumps(request, indent=2)}", file=sys.stderr)
+        
+        # Requests that queued past their whole timeout are not started
+        if time.monotonic() >= deadline:
+            raise DeadlineExceeded("Request deadline exceeded before it was dispatched")
+        
+        # Handle the method
+        if method == 'fillPharmaCareForm':
+            # Validate parameters before any PDF work
+            params = validator.validate(request.get('params', {}))
             
-            # Handle the method
-            if request.get('method') == 'fillPharmaCareForm':
-                # Extract parameters
-                params = request.get('params', {})
-                
-                # Call the PDF filler
-                result = handle_pdf_request(params)
-                
-                # Send JSON-RPC response
-                response = {
-                    "jsonrpc": "2.0",
-                    "result": result,
-                    "id": request.get('id')
-                }
-            else:
-                # Method not found
-                response = {
-                    "jsonrpc": "2.0",
-                    "error": {
-                        "code": -32601,
-                        "message": "Method not found"
-                    },
-                    "id": request.get('id')
-                }
-                
-        except Exception as e:
-            # Error response
-            response = {
-                "jsonrpc": "2.0",
-                "error": {
-                    "code": -32603,
-                    "message": str(e)
-                },
-                "id": request.get('id', None)
+            # Run the fill on a worker process
+            result = pool.submit(params, deadline, profiler.session(), cancelled)
+            stats.record(success=result.get('success', False))
+        elif method == 'submitFillJob':
+            result = submit_job(request.get('params', {}))
+        elif method in ('getJobStatus', 'getJobResult'):
+            result = job_status(request.get('params', {}), with_result=method == 'getJobResult')
+        elif method == 'getServerStats':
+            result = stats.snapshot()
+        elif method in ADMIN_METHODS:
+            if not admin:
+                return error_response(UNAUTHORIZED, "Admin token required", request.get('id'))
+            result = handle_admin(method, request.get('params', {}))
+        else:
+            # Method not found
+            return error_response(METHOD_NOT_FOUND, "Method not found", request.get('id'))
+        
+        # Send JSON-RPC response
+        return {
+            "jsonrpc": "2.0",
+            "result": result,
+            "id": request.get('id')
+        }
+    
+    except ValidationError as e:
+        if method == 'fillPharmaCareForm':
+            stats.record(success=False)
+        return error_response(INVALID_PARAMS, str(e), request.get('id'))
+    except DeadlineExceeded as e:
+        if method == 'fillPharmaCareForm':
+            stats.record(success=False)
+        return error_response(REQUEST_TIMEOUT, str(e), request.get('id'))
+    except RequestCancelled:
+        # Nobody is left to answer
+        raise
+    except Exception as e:
+        if method == 'fillPharmaCareForm':
+            stats.record(success=False)
+        return error_response(INTERNAL_ERROR, str(e), request.get('id'))
+
+
+def submit_job(params):
+    """Validate a fill and queue it; returns the job id straight away"""
+    if not isinstance(params, dict):
+        raise ValidationError("params must be an object")
+    unknown = set(params) - {'form', 'priority', 'max_attempts'}
+    if unknown:
+        raise ValidationError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    form = validator.validate(params.get('form', {}))
+    priority = params.get('priority', 0)
+    if not (isinstance(priority, int) and -10 <= priority <= 10):
+        raise ValidationError("priority must be an integer between -10 and 10")
+    max_attempts = params.get('max_attempts', 3)
+    if not (isinstance(max_attempts, int) and 1 <= max_attempts <= 10):
+        raise ValidationError("max_attempts must be an integer between 1 and 10")
+    job_id = jobs.submit(form, priority, max_attempts)
+    return {"job_id": job_id, "status": "queued"}
+
+
+def job_status(params, with_result):
+    """getJobStatus / getJobResult"""
+    job_id = params.get('job_id') if isinstance(params, dict) else None
+    if not isinstance(job_id, str):
+        raise ValidationError("job_id is required")
+    info = jobs.status(job_id, with_result)
+    if info is None:
+        raise ValidationError(f"Unknown job: {job_id}")
+    return info
+
+
+def handle_admin(method, params):
+    """Profiling controls: startProfiling, stopProfiling, getProfilingReport"""
+    if not isinstance(params, dict):
+        raise ValidationError("params must be an object")
+    if method == 'startProfiling':
+        requests = params.get('requests')
+        seconds = params.get('seconds')
+        if requests is None and seconds is None:
+            requests = 10
+        if requests is not None and not (isinstance(requests, int) and 0 < requests <= 10000):
+            raise ValidationError("requests must be an integer between 1 and 10000")
+        if seconds is not None and not (isinstance(seconds, (int, float)) and 0 < seconds <= 3600):
+            raise ValidationError("seconds must be between 0 and 3600")
+        top = params.get('top', 20)
+        if not (isinstance(top, int) and 0 < top <= 200):
+            raise ValidationError("top must be an integer between 1 and 200")
+        return profiler.start(requests, seconds, bool(params.get('cpu', True)),
+                              bool(params.get('memory', False)), top)
+    if method == 'stopProfiling':
+        return profiler.stop()
+    return profiler.report()
+
+
+class Profiler:
+    """On-demand profiling of the next N fills or of a time window
+
+    While inactive, session() is a single attribute check, so leaving
+    this in production costs nothing. Workers do the measuring (see
+    worker_pool); results are merged here, written under PROFILE_DIR and
+    returned inline.
+    """
+    
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+        self.lock = threading.Lock()
+        self.active = False
+        self.options = None
+        self.last_report = None
+        # Increases with every session, so late results of an old one are ignored
+        self.session_id = 0
+    
+    def start(self, requests=None, seconds=None, cpu=True, memory=False, top=20):
+        with self.lock:
+            if self.active:
+                raise ValidationError("Profiling is already active")
+            session_dir = os.path.join(self.base_dir, datetime.now().strftime('%Y%m%d_%H%M%S'))
+            os.makedirs(session_dir, exist_ok=True)
+            self.options = {"cpu": cpu, "memory": memory, "top": top, "dir": session_dir}
+            self.remaining = requests
+            self.ends = time.monotonic() + seconds if seconds else None
+            self.in_flight = 0
+            self.profiled = 0
+            self.cpu_files = []
+            self.allocations = {}
+            self.field_seconds = {}
+            self.session_id += 1
+            self.active = True
+            return {"active": True, "dir": session_dir, "requests": requests, "seconds": seconds}
+    
+    def session(self):
+        """A ProfileSession if the next fill should be profiled, else None"""
+        if not self.active:
+            return None
+        with self.lock:
+            if not self.active or self._exhausted():
+                self._finish_if_idle()
+                return None
+            if self.remaining is not None:
+                self.remaining -= 1
+            self.in_flight += 1
+            return ProfileSession(self, self.session_id, self.options)
+    
+    def _exhausted(self):
+        return self.remaining == 0 or (self.ends is not None and time.monotonic() >= self.ends)
+    
+    def _finish_if_idle(self):
+        if self.active and self.in_flight == 0 and self._exhausted():
+            self._finish()
+    
+    def record(self, session_id, measurements):
+        """Merge one worker's measurements (None if the fill failed)
+
+        Fills that started under an earlier session are dropped, along
+        with their profile data file.
+        """
+        with self.lock:
+            if not self.active or session_id != self.session_id:
+                if measurements and 'cpu_file' in measurements:
+                    os.remove(measurements['cpu_file'])
+                return
+            self.in_flight -= 1
+            if measurements is not None:
+                self.profiled += 1
+                if 'cpu_file' in measurements:
+                    self.cpu_files.append(measurements['cpu_file'])
+                for site, size, count in measurements.get('allocations', []):
+                    totals = self.allocations.setdefault(site, [0, 0])
+                    totals[0] += size
+                    totals[1] += count
+                for field, seconds in measurements['field_seconds'].items():
+                    self.field_seconds[field] = self.field_seconds.get(field, 0.0) + seconds
+            self._finish_if_idle()
+    
+    def stop(self):
+        with self.lock:
+            if self.active:
+                self._finish()
+            return self.last_report
+    
+    def report(self):
+        with self.lock:
+            self._finish_if_idle()
+            return {"active": self.active, "report": self.last_report}
+    
+    def _finish(self):
+        """Combine the session's measurements into a report and write it out"""
+        session_dir = self.options['dir']
+        top = self.options['top']
+        report = {
+            "finished": datetime.now().isoformat(timespec='seconds'),
+            "requests_profiled": self.profiled,
+            "field_seconds": {
+                field: {"total": round(total, 6),
+                        "per_request": round(total / self.profiled, 6)}
+                for field, total in sorted(self.field_seconds.items(),
+                                           key=lambda item: -item[1])
+            } if self.profiled else {},
+            "files": {"report": os.path.join(session_dir, 'report.json')},
+        }
+        
+        if self.cpu_files:
+            combined = pstats.Stats(*self.cpu_files)
+            cpu_path = os.path.join(session_dir, 'cpu.prof')
+            combined.dump_stats(cpu_path)
+            for path in self.cpu_files:
+                os.remove(path)
+            report["files"]["cpu"] = cpu_path
+            by_cumulative = sorted(combined.stats.items(), key=lambda item: -item[1][3])
+            report["top_cumulative"] = [
+                {"function": f"{filename}:{line}({name})", "calls": calls,
+                 "total_seconds": round(total, 6), "cumulative_seconds": round(cumulative, 6)}
+                for (filename, line, name), (_, calls, total, cumulative, _) in by_cumulative[:top]
+            ]
+        
+        if self.allocations:
+            by_size = sorted(self.allocations.items(), key=lambda item: -item[1][0])
+            report["top_allocations"] = [
+                {"site": site, "bytes": size, "count": count}
+                for site, (size, count) in by_size[:top]
+            ]
+        
+        with open(report["files"]["report"], 'w') as f:
+            json.dump(report, f, indent=2)
+        self.last_report = report
+        self.active = False
+
+
+class ProfileSession:
+    """One fill's handle on the profiling session that was active when it started
+
+    WorkerPool.submit() sends options with the job and calls record().
+    """
+    
+    def __init__(self, profiler, session_id, options):
+        self.profiler = profiler
+        self.session_id = session_id
+        self.options = options
+    
+    def record(self, measurements):
+        self.profiler.record(self.session_id, measurements)
+
+
+class ServerStats:
+    """Request counters and process resource usage for getServerStats"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.fills = 0
+        self.failures = 0
+        self.cancelled = 0
+    
+    def record(self, success):
+        with self.lock:
+            self.fills += 1
+            if not success:
+                self.failures += 1
+    
+    def record_cancelled(self):
+        with self.lock:
+            self.cancelled += 1
+    
+    def snapshot(self):
+        times = os.times()
+        with self.lock:
+            return {
+                "uptime_seconds": round(time.time() - self.started, 3),
+                "fills": self.fills,
+                "failures": self.failures,
+                "cancelled": self.cancelled,
+                "cpu_user_seconds": times.user,
+                "cpu_system_seconds": times.system,
+                "rss_bytes": current_rss(),
+                "ready": ready.is_set(),
+                "startup_seconds": startup_seconds,
+                "pool": pool.snapshot() if pool else None,
+                "jobs": jobs.counts() if jobs else None,
             }
+
+
+stats = ServerStats()
+profiler = Profiler(PROFILE_DIR)
+
+
+# Filled forms never change once written
+FORM_CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+
+def content_disposition(filename):
+    """Content-Disposition value that stays Latin-1 safe for any filename
+
+    Sends an ASCII filename= fallback plus the exact UTF-8 name as
+    filename* (RFC 5987).
+    """
+    ascii_name = unicodedata.normalize('NFKD', filename).encode('ascii', 'ignore').decode()
+    ascii_name = ascii_name.replace('"', '').replace('\\', '') or 'form.pdf'
+    return f"inline; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(filename, safe='')}"
+
+
+def parse_byte_range(header, size):
+    """Parse a single-range Range header into inclusive (start, end)
+
+    Returns None when the whole file should be sent (no header, or a
+    multi-range request we choose to ignore). Raises ValueError when the
+    range cannot be satisfied.
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    start, sep, end = header[len('bytes='):].strip().partition('-')
+    if not sep:
+        return None
+    try:
+        if not start:
+            # Suffix range: the last N bytes
+            length = int(end)
+            if length <= 0:
+                raise ValueError("Empty suffix range")
+            return max(0, size - length), size - 1
+        start = int(start)
+        end = int(end) if end else size - 1
+    except ValueError:
+        raise ValueError("Malformed range")
+    if start >= size or end < start:
+        raise ValueError("Range not satisfiable")
+    return start, min(end, size - 1)
+
+
+
+
+def json_reply(status, response):
+    """A JSON reply as (status, headers, body)"""
+    body = json.dumps(response).encode('utf-8')
+    return status, [('Content-Type', 'application/json'),
+                    ('Content-Length', str(len(body)))], body
+
+
+def admit_post(headers):
+    """Check a POST before its body is read; returns (content_length, refusal)
+
+    refusal is None, or a (status, headers, body) reply to send before
+    closing the connection.
+    """
+    if not ready.is_set():
+        return None, json_reply(503, error_response(SERVER_NOT_READY, "Server is warming up"))
+    
+    # Reject missing or oversized bodies before reading them
+    try:
+        content_length = int(headers.get('Content-Length', ''))
+    except ValueError:
+        return None, json_reply(411, error_response(INVALID_REQUEST, "Content-Length required"))
+    if content_length < 0 or content_length > MAX_BODY_BYTES:
+        return None, json_reply(413, error_response(
+            INVALID_REQUEST, f"Request body exceeds {MAX_BODY_BYTES} bytes"))
+    return content_length, None
+
+
+def process_post(body, headers, cancelled=None, received=None):
+    """Parse and dispatch a JSON-RPC POST body; returns (status, headers, body)
+
+    The deadline runs from received, the monotonic time the request
+    headers arrived (default now), so time spent queued counts against it.
+    Raises RequestCancelled if cancelled is set while a fill is still
+    waiting for a worker.
+    """
+    try:
+        request = json.loads(body.decode('utf-8'))
+    except (UnicodeDecodeError, ValueError):
+        return json_reply(200, error_response(PARSE_ERROR, "Parse error"))
+    
+    try:
+        deadline = request_deadline(headers.get('X-Request-Timeout'), received)
+    except ValidationError as e:
+        return json_reply(200, error_response(INVALID_PARAMS, str(e), _request_id(request)))
+    
+    admin = is_admin(headers)
+    if isinstance(request, list):
+        # JSON-RPC batch: one deadline covers the whole batch
+        if not request or len(request) > MAX_BATCH_SIZE:
+            response = error_response(
+                INVALID_REQUEST, f"Batch must hold 1 to {MAX_BATCH_SIZE} requests")
+        else:
+            response = [handle_rpc(item, deadline, admin, cancelled) for item in request]
+    else:
+        response = handle_rpc(request, deadline, admin, cancelled)
+    return json_reply(200, response)
+
+
+def route_get(path, headers):
+    """Reply to a GET or HEAD as (status, headers, body)"""
+    path = path.split('?', 1)[0]
+    if path.startswith('/forms/'):
+        return form_reply(path[len('/forms/'):], headers)
+    if path == '/healthz':
+        # Liveness: the process is up and answering
+        return json_reply(200, {"status": "ok"})
+    if path == '/readyz':
+        # Readiness: workers are warm and fills can be routed here
+        if ready.is_set():
+            return json_reply(200, {"status": "ready", "startup_seconds": startup_seconds})
+        return json_reply(503, {"status": "starting"})
+    return json_reply(404, {"error": "Not found"})
+
+
+def form_reply(output_id, headers):
+    """Reply for a filled form by output id, honouring Range and conditional headers
+
+    For stored PDFs the body is (file, offset, count), to be sent with
+    sendfile, which uses the zero-copy os.sendfile() where available; the
+    caller closes the file. Overlay records are rendered on a worker (or
+    taken from the store's cache) and returned as bytes.
+    """
+    try:
+        record = store.lookup(output_id)
+    except ValueError:
+        record = None
+    if record is None:
+        return json_reply(404, {"error": "Unknown form id"})
+    
+    etag = f'"{output_id}"'
+    if record.get('kind', 'pdf') == 'overlay':
+        # Overlays are rendered again on demand, and an upgrade of the
+        # render code can change their bytes, so it changes the tag too
+        etag = f'"{output_id}-r{render_version()}"'
+    created = datetime.fromisoformat(record['created']).timestamp()
+    if not_modified(headers, etag, created):
+        return 304, [('ETag', etag), ('Cache-Control', FORM_CACHE_CONTROL)], None
+    
+    f = None
+    try:
+        if record.get('kind', 'pdf') == 'pdf':
+            f = open(store.full_path(record), 'rb')
+            size = os.fstat(f.fileno()).st_size
+        else:
+            if not ready.is_set():
+                return json_reply(503, {"error": "Server is warming up"})
+            # Render on a worker like a fill, waiting at most DEFAULT_TIMEOUT
+            deadline = time.monotonic() + DEFAULT_TIMEOUT
+            try:
+                data = store.materialize(output_id, lambda oid: pool.render(oid, deadline))
+            except DeadlineExceeded:
+                return json_reply(503, {"error": "Form could not be rendered in time"})
+            size = len(data)
         
-        # Send response
-        self.send_response(200)
-        self.send_header('Content-Type', 'application/json')
-        self.end_headers()
-        self.wfile.write(json.dumps(response).encode('utf-8'))
+        byte_range = None
+        if headers.get('If-Range') in (None, etag):
+            try:
+                byte_range = parse_byte_range(headers.get('Range'), size)
+            except ValueError:
+                if f is not None:
+                    f.close()
+                return 416, [('Content-Range', f'bytes */{size}'), ('Content-Length', '0')], None
+        
+        start, end = byte_range or (0, size - 1)
+        reply_headers = []
+        if byte_range:
+            reply_headers.append(('Content-Range', f'bytes {start}-{end}/{size}'))
+        reply_headers += [
+            ('Content-Type', 'application/pdf'),
+            ('Content-Length', str(end - start + 1)),
+            ('Content-Disposition',
+             content_disposition(f'{record["patient_key"]}_{output_id}.pdf')),
+            ('Accept-Ranges', 'bytes'),
+            ('ETag', etag),
+            ('Last-Modified', formatdate(created, usegmt=True)),
+            ('Cache-Control', FORM_CACHE_CONTROL),
+        ]
+        body = (f, start, end - start + 1) if f is not None else data[start:end + 1]
+        return (206 if byte_range else 200), reply_headers, body
+    except BaseException:
+        if f is not None:
+            f.close()
+        raise
+
+
+def not_modified(headers, etag, created):
+    """Evaluate If-None-Match, falling back to If-Modified-Since"""
+    if_none_match = headers.get('If-None-Match')
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or etag in tags or f'W/{etag}' in tags
+    if_modified_since = headers.get('If-Modified-Since')
+    if if_modified_since:
+        try:
+            return int(created) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+class JSONRPCHandler(BaseHTTPRequestHandler):
+    def do_HEAD(self):
+        self._send(*route_get(self.path, self.headers), send_body=False)
+    
+    def do_GET(self):
+        self._send(*route_get(self.path, self.headers))
+    
+    def do_POST(self):
+        received = time.monotonic()
+        content_length, refusal = admit_post(self.headers)
+        if refusal:
+            self.close_connection = True
+            self._send(*refusal)
+            return
+        self._send(*process_post(self.rfile.read(content_length), self.headers,
+                                 received=received))
+    
+    def _send(self, status, headers, body, send_body=True):
+        """Send a (status, headers, body) reply"""
+        f = body[0] if isinstance(body, tuple) else None
+        try:
+            self.send_response(status)
+            for name, value in headers:
+                self.send_header(name, value)
+            self.end_headers()
+            if not send_body:
+                return
+            if f is not None:
+                _, offset, count = body
+                if count:
+                    self.connection.sendfile(f, offset, count)
+            elif body:
+                self.wfile.write(body)
+        finally:
+            if f is not None:
+                f.close()
     
     def log_message(self, format, *args):
         # Log to stderr
@@ -76,12 +663,295 @@ class JSONRPCHandler(BaseHTTPRequestHandler):
                           self.log_date_time_string(),
                           format%args))
 
-def run_server(port=8080):
-    server_address = ('localhost', port)
-    httpd = HTTPServer(server_address, JSONRPCHandler)
-    print(f"JSON-RPC Server running on http://localhost:{port}", file=sys.stderr)
-    print(f"Method: fillPharmaCareForm", file=sys.stderr)
-    httpd.serve_forever()
+
+# asyncio front end
+KEEPALIVE_TIMEOUT = 75.0  # seconds an idle keep-alive connection is kept open
+BODY_TIMEOUT = 30.0  # seconds to receive a request body once its headers arrived
+MAX_HEADER_BYTES = 16 * 1024
+ASYNC_DISPATCH_THREADS = 32
+SHUTDOWN_TIMEOUT = MAX_TIMEOUT + 10.0
+
+
+def _count_if_cancelled(work):
+    """Done callback: count a request whose fill gave up waiting for a worker"""
+    if not work.cancelled() and isinstance(work.exception(), RequestCancelled):
+        stats.record_cancelled()
+
+
+class _ConnectionProtocol(asyncio.StreamReaderProtocol):
+    """Stream protocol that also signals when the client closes or drops the connection"""
+    
+    def __init__(self, client_connected_cb):
+        super().__init__(asyncio.StreamReader(limit=MAX_HEADER_BYTES), client_connected_cb)
+        self.disconnected = asyncio.Event()
+    
+    def eof_received(self):
+        self.disconnected.set()
+        return super().eof_received()
+    
+    def connection_lost(self, exc):
+        self.disconnected.set()
+        super().connection_lost(exc)
+
+
+class AsyncFrontEnd:
+    """HTTP/1.1 front end on a single asyncio event loop
+
+    Idle and keep-alive connections cost only a little memory instead of
+    a thread each. Request handling runs in a thread pool. If the client
+    disconnects (or half-closes its socket) before its fill reaches a
+    worker, the fill is cancelled; fills already running finish.
+    """
+    
+    def __init__(self, threads=ASYNC_DISPATCH_THREADS):
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='rpc')
+        # Connection task -> its writer, and the tasks handling a request
+        self.connections = {}
+        self.busy = set()
+        self.closing = False
+    
+    async def handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self.connections[task] = writer
+        try:
+            while not self.closing:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'),
+                                                  KEEPALIVE_TIMEOUT)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                        asyncio.TimeoutError):
+                    break
+                self.busy.add(task)
+                try:
+                    keep_alive = await self._handle_request(head, reader, writer)
+                finally:
+                    self.busy.discard(task)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        finally:
+            del self.connections[task]
+            writer.close()
+    
+    async def _handle_request(self, head, reader, writer):
+        """Read the rest of one request and reply; returns whether to keep the connection"""
+        received = time.monotonic()
+        request_line, _, header_block = head.partition(b'\r\n')
+        try:
+            method, target, version = request_line.decode('latin-1').split(' ')
+            if version not in ('HTTP/1.0', 'HTTP/1.1'):
+                raise ValueError(version)
+            headers = http.client.parse_headers(io.BytesIO(header_block))
+        except (ValueError, http.client.HTTPException):
+            await self._reply(writer, *json_reply(400, {"error": "Bad request"}), keep_alive=False)
+            return False
+        connection = headers.get('Connection', '').lower()
+        keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+        
+        if method == 'POST':
+            content_length, refusal = admit_post(headers)
+            if refusal:
+                await self._reply(writer, *refusal, keep_alive=False)
+                self._log(writer, request_line, refusal[0])
+                return False
+            if headers.get('Expect', '').lower() == '100-continue':
+                writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+            body = await asyncio.wait_for(reader.readexactly(content_length), BODY_TIMEOUT)
+            reply = await self._run_post(body, headers, received, writer)
+            if reply is None:
+                self._log(writer, request_line, 'cancelled')
+                return False
+        elif method in ('GET', 'HEAD'):
+            if target.startswith('/forms/'):
+                # Index reads and overlay rendering block, so keep them off the loop
+                reply = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, route_get, target, headers)
+            else:
+                reply = route_get(target, headers)
+        else:
+            reply = json_reply(501, {"error": f"Unsupported method {method}"})
+        
+        keep_alive = keep_alive and not self.closing
+        await self._reply(writer, *reply, keep_alive=keep_alive, send_body=method != 'HEAD')
+        self._log(writer, request_line, reply[0])
+        return keep_alive
+    
+    async def _run_post(self, body, headers, received, writer):
+        """Dispatch a POST in the thread pool; returns its reply, or None if the client left"""
+        cancelled = threading.Event()
+        work = self.executor.submit(process_post, body, headers, cancelled, received)
+        future = asyncio.wrap_future(work)
+        disconnected = asyncio.ensure_future(writer.transport.get_protocol().disconnected.wait())
+        try:
+            await asyncio.wait({future, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            disconnected.cancel()
+        if future.done():
+            try:
+                return future.result()
+            except RequestCancelled:
+                return None
+        # Drop the request if no thread has picked it up yet, and make a
+        # fill still waiting for a worker give up; fills already running
+        # finish and are not counted as cancelled
+        cancelled.set()
+        if work.cancel():
+            stats.record_cancelled()
+        else:
+            work.add_done_callback(_count_if_cancelled)
+        future.cancel()
+        return None
+    
+    async def _reply(self, writer, status, headers, body, keep_alive=True, send_body=True):
+        """Write a (status, headers, body) reply"""
+        lines = [f'HTTP/1.1 {status} {HTTPStatus(status).phrase}',
+                 f'Date: {formatdate(usegmt=True)}']
+        lines += [f'{name}: {value}' for name, value in headers]
+        lines.append('Connection: keep-alive' if keep_alive else 'Connection: close')
+        head = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+        
+        f = body[0] if isinstance(body, tuple) else None
+        try:
+            if f is None:
+                writer.write(head + body if send_body and body else head)
+                await writer.drain()
+                return
+            writer.write(head)
+            await writer.drain()
+            _, offset, count = body
+            if send_body and count:
+                await asyncio.get_running_loop().sendfile(writer.transport, f, offset, count)
+        finally:
+            if f is not None:
+                f.close()
+    
+    def _log(self, writer, request_line, status):
+        peer = writer.get_extra_info('peername')
+        sys.stderr.write('%s - - [%s] "%s" %s -\n' %
+                         (peer[0] if peer else '-', time.strftime('%d/%b/%Y %H:%M:%S'),
+                          request_line.decode('latin-1'), status))
+    
+    async def drain(self, timeout):
+        """Close idle connections and wait for requests in progress to finish"""
+        self.closing = True
+        for task, writer in list(self.connections.items()):
+            if task not in self.busy:
+                writer.close()
+        if self.connections:
+            _, unfinished = await asyncio.wait(list(self.connections), timeout=timeout)
+            for task in unfinished:
+                self.connections[task].transport.abort()
+
+
+async def serve_async(host, port, runner):
+    """Serve with AsyncFrontEnd until SIGINT/SIGTERM, then shut down gracefully"""
+    loop = asyncio.get_running_loop()
+    front = AsyncFrontEnd()
+    stop = asyncio.Event()
+    server = await loop.create_server(lambda: _ConnectionProtocol(front.handle_connection),
+                                      host, port, backlog=1024)
+    announce(host, port, 'asyncio')
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signum, stop.set)
+        except NotImplementedError:
+            # Windows: Ctrl+C cancels this coroutine instead
+            pass
+    threading.Thread(target=warm_up, args=(runner, lambda: loop.call_soon_threadsafe(stop.set)),
+                     daemon=True).start()
+    try:
+        await stop.wait()
+    except asyncio.CancelledError:
+        pass
+    
+    # Refuse new connections, then let requests in progress finish
+    logging.info("Shutting down: waiting for requests in progress")
+    ready.clear()
+    server.close()
+    await front.drain(SHUTDOWN_TIMEOUT)
+    front.executor.shutdown(wait=True, cancel_futures=True)
+
+
+def serve_threaded(host, port, runner):
+    """Serve with a thread per connection until interrupted"""
+    # Listen right away so /healthz and /readyz answer during warm-up;
+    # fills are refused until warm_up() marks the server ready
+    httpd = ThreadingHTTPServer((host, port), JSONRPCHandler)
+    announce(host, port, 'threaded')
+    threading.Thread(target=warm_up, args=(runner, httpd.shutdown), daemon=True).start()
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.server_close()
+
+
+def announce(host, port, mode):
+    print(f"JSON-RPC Server running on http://{host}:{port} with {pool.size} workers "
+          f"({mode})", file=sys.stderr)
+    print(f"Methods: fillPharmaCareForm, submitFillJob, getJobStatus, getJobResult, "
+          f"getServerStats", file=sys.stderr)
+
+
+def run_server(port=8080, host='localhost', workers=2,
+               max_requests_per_worker=500, max_worker_rss_mb=400, use_asyncio=False):
+    global pool
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    pool = WorkerPool(workers, max_requests_per_worker, max_worker_rss_mb)
+    runner = JobRunner(JobQueue(), pool.submit, workers)
+    try:
+        if use_asyncio:
+            asyncio.run(serve_async(host, port, runner))
+        else:
+            serve_threaded(host, port, runner)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ready.clear()
+        runner.stop()
+        runner.jobs.close()
+        pool.close()
+
+
+def warm_up(runner, on_failure):
+    """Load the mapping, start warm workers and the job runner, then mark ready
+
+    on_failure is called if startup fails, to stop the server.
+    """
+    global validator, jobs, startup_seconds
+    started = time.perf_counter()
+    try:
+        validator = ParamValidator(load_mapping())
+        pool.start()
+        jobs = runner.jobs
+        requeued = jobs.recover()
+        if requeued:
+            logging.info(f"Requeued {requeued} jobs interrupted by the last shutdown")
+        runner.start()
+    except Exception as e:
+        logging.error(f"Startup failed: {e}")
+        on_failure()
+        return
+    startup_seconds = round(time.perf_counter() - started, 3)
+    ready.set()
+    logging.info(f"Server ready after {startup_seconds}s warm-up")
 
 if __name__ == "__main__":
-    run_server()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="PharmaCare form JSON-RPC server")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=2,
+                        help="Number of fill worker processes")
+    parser.add_argument('--max-requests-per-worker', type=int, default=500,
+                        help="Recycle a worker after this many requests")
+    parser.add_argument('--max-worker-rss-mb', type=int, default=400,
+                        help="Recycle a worker once its RSS exceeds this (0 = no limit)")
+    parser.add_argument('--asyncio', action='store_true',
+                        help="Serve from one asyncio event loop with keep-alive, cancelling "
+                             "queued fills when clients disconnect")
+    args = parser.parse_args()
+    run_server(args.port, args.host, args.workers,
+               args.max_requests_per_worker, args.max_worker_rss_mb, args.asyncio)
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+"""
+Load Test for the PharmaCare JSON-RPC Server
+Replays requests.jsonl (or synthetic variants of it) against a server on
+localhost and reports throughput, latency percentiles, errors and the
+server's own resource usage.
+
+Each line of the requests file is either a full JSON-RPC request or just
+the params object for fillPharmaCareForm.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# The server rejects a larger X-Request-Timeout (json_rpc_server.MAX_TIMEOUT)
+SERVER_MAX_TIMEOUT = 120.0
+
+SYNTHETIC_NAMES = ["Smith, John", "Nguyen, Anh", "Patel, Priya", "Brown, Mary",
+                   "Wong, David", "Martin, Claire", "Singh, Arjun", "Lee, Grace"]
+SYNTHETIC_SYMPTOMS = [
+    "Burning sensation when urinating for 2 days.",
+    "Red, itchy eye with discharge since yesterday.",
+    "Sore throat and mild fever. No cough.",
+    "Patient presents with severe headache lasting 3 days, accompanied by "
+    "nausea and photophobia. Previous history of migraines.",
+]
+
+
+def load_requests(path):
+    """Read JSON-RPC requests from a JSONL file"""
+    requests = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            if 'method' not in item:
+                item = {"jsonrpc": "2.0", "method": "fillPharmaCareForm", "params": item}
+            requests.append(item)
+    return requests
+
+
+def synthetic_requests(count, base=None, seed=None):
+    """Generate fill requests by varying the base requests, or from scratch"""
+    rng = random.Random(seed)
+    with open(os.path.join(HERE, 'macs_form_mapping_v3.json'), 'r') as f:
+        mapping = json.load(f)
+    conditions = [box['number'] for box in mapping.get('condition_boxes', [])]
+
+    requests = []
+    for _ in range(count):
+        if base:
+            params = dict(rng.choice(base).get('params', {}))
+        else:
+            params = {"symptoms": rng.choice(SYNTHETIC_SYMPTOMS)}
+        params['patient_name'] = rng.choice(SYNTHETIC_NAMES)
+        params['phn'] = str(rng.randint(9000000000, 9999999999))
+        params['condition_numbers'] = rng.sample(conditions, rng.randint(1, 3))
+        requests.append({"jsonrpc": "2.0", "method": "fillPharmaCareForm", "params": params})
+    return requests
+
+
+def rpc_call(host, port, payload, timeout):
+    """POST a JSON-RPC payload and return the decoded response
+
+    The server deadline is capped at SERVER_MAX_TIMEOUT; a longer timeout
+    only applies to the client socket.
+    """
+    body = json.dumps(payload).encode('utf-8')
+    conn = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        conn.request('POST', '/', body, {
+            'Content-Type': 'application/json',
+            'X-Request-Timeout': str(min(timeout, SERVER_MAX_TIMEOUT)),
+        })
+        response = conn.getresponse()
+        data = response.read()
+        if response.status != 200:
+            raise RuntimeError(f"HTTP {response.status}")
+        return json.loads(data)
+    finally:
+        conn.close()
+
+
+def server_stats(host, port):
+    """Fetch getServerStats, or None if the server does not answer"""
+    try:
+        reply = rpc_call(host, port, {"jsonrpc": "2.0", "method": "getServerStats", "id": 0}, 10)
+        return reply.get('result')
+    except (OSError, RuntimeError, ValueError):
+        return None
+
+
+class Recorder:
+    """Collects per-call latencies and outcome counts from many threads"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.outcomes = {}
+
+    def add(self, latency, outcome, n=1):
+        with self.lock:
+            self.latencies.append(latency)
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + n
+
+
+def classify(reply):
+    """Map one JSON-RPC response object to an outcome label"""
+    if 'error' in reply:
+        return f"rpc_error_{reply['error'].get('code')}"
+    if not reply.get('result', {}).get('success', False):
+        return "fill_failed"
+    return "ok"
+
+
+def send_batch(host, port, batch, timeout, recorder, scheduled=None):
+    """Send one request (or batch) and record the outcome
+
+    Latency is measured from the scheduled start when given, so queueing
+    delay in open-loop mode is not hidden (coordinated omission).
+    """
+    start = scheduled if scheduled is not None else time.perf_counter()
+    payload = batch if len(batch) > 1 else batch[0]
+    try:
+        reply = rpc_call(host, port, payload, timeout)
+        replies = reply if isinstance(reply, list) else [reply]
+        latency = time.perf_counter() - start
+        for item in replies:
+            recorder.add(latency, classify(item))
+    except socket.timeout:
+        recorder.add(time.perf_counter() - start, "client_timeout", len(batch))
+    except (OSError, RuntimeError, ValueError, http.client.HTTPException) as e:
+        recorder.add(time.perf_counter() - start, f"transport_{type(e).__name__}", len(batch))
+
+
+def make_batches(requests, total, batch_size):
+    """Cycle through requests, giving each a unique id, grouped into batches"""
+    batches = []
+    for i in range(0, total, batch_size):
+        batch = []
+        for j in range(i, min(i + batch_size, total)):
+            item = dict(requests[j % len(requests)])
+            item['id'] = j + 1
+            batch.append(item)
+        batches.append(batch)
+    return batches
+
+
+def run_closed_loop(host, port, batches, concurrency, timeout, recorder):
+    """Each worker sends its next batch as soon as the previous one returns"""
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for batch in batches:
+            pool.submit(send_batch, host, port, batch, timeout, recorder)
+
+
+def run_open_loop(host, port, batches, rate, concurrency, timeout, recorder, seed=None):
+    """Send batches at Poisson arrivals of the given rate, regardless of replies"""
+    rng = random.Random(seed)
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        next_time = time.perf_counter()
+        for batch in batches:
+            next_time += rng.expovariate(rate)
+            delay = next_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(send_batch, host, port, batch, timeout, recorder, next_time)
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, math.ceil(pct * len(sorted_values) / 100) - 1))
+    return sorted_values[index]
+
+
+def cpu_seconds(stats):
+    """User plus system CPU seconds from a stats dict"""
+    return stats["cpu_user_seconds"] + stats["cpu_system_seconds"]
+
+
+def build_report(recorder, elapsed, before, after):
+    """Summarize a run as a dict"""
+    latencies = sorted(recorder.latencies)
+    total = sum(recorder.outcomes.values())
+    errors = total - recorder.outcomes.get('ok', 0)
+    report = {
+        "requests": total,
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_per_second": round(total / elapsed, 2) if elapsed else None,
+        "error_rate": round(errors / total, 4) if total else None,
+        "outcomes": recorder.outcomes,
+        "latency_ms": {
+            name: round(percentile(latencies, pct) * 1000, 1) if latencies else None
+            for name, pct in (("p50", 50), ("p95", 95), ("p99", 99), ("max", 100))
+        },
+    }
+    if before and after:
+        dispatcher_cpu = cpu_seconds(after) - cpu_seconds(before)
+        pool = after.get("pool")
+        worker_cpu = (cpu_seconds(pool) - cpu_seconds(before["pool"])
+                      if pool and before.get("pool") else 0.0)
+        report["server"] = {
+            "fills": after["fills"] - before["fills"],
+            "failures": after["failures"] - before["failures"],
+            # The dispatcher process plus its fill workers
+            "cpu_seconds": round(dispatcher_cpu + worker_cpu, 3),
+            "dispatcher_cpu_seconds": round(dispatcher_cpu, 3),
+            "worker_cpu_seconds": round(worker_cpu, 3),
+            "rss_bytes_before": before.get("rss_bytes"),
+            "rss_bytes_after": after.get("rss_bytes"),
+        }
+        if pool and before.get("pool"):
+            report["server"]["workers_recycled"] = pool["recycled"] - before["pool"]["recycled"]
+            report["server"]["worker_rss_bytes"] = [w.get("rss_bytes") for w in pool["workers"]]
+    return report
+
+
+def print_report(report):
+    print(f"Requests:    {report['requests']} in {report['elapsed_seconds']}s "
+          f"({report['throughput_per_second']}/s)")
+    print(f"Error rate:  {report['error_rate']}")
+    for outcome, count in sorted(report['outcomes'].items()):
+        print(f"  {outcome}: {count}")
+    latency = report['latency_ms']
+    print(f"Latency ms:  p50={latency['p50']} p95={latency['p95']} "
+          f"p99={latency['p99']} max={latency['max']}")
+    server = report.get('server')
+    if server:
+        print(f"Server:      {server['fills']} fills, {server['failures']} failures, "
+              f"{server['cpu_seconds']}s CPU ({server['worker_cpu_seconds']}s in workers), "
+              f"RSS {server['rss_bytes_before']} -> "
+              f"{server['rss_bytes_after']} bytes")
+        if 'workers_recycled' in server:
+            print(f"Workers:     {server['workers_recycled']} recycled, "
+                  f"RSS {server['worker_rss_bytes']} bytes")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def server_ready(host, port):
+    """True once the server's /readyz reports it is warm"""
+    conn = http.client.HTTPConnection(host, port, timeout=5)
+    try:
+        conn.request('GET', '/readyz')
+        return conn.getresponse().status == 200
+    except OSError:
+        return False
+    finally:
+        conn.close()
+
+
+def start_local_server(port, startup_timeout=60, extra_args=(), data_dir=None):
+    """Start json_rpc_server.py on localhost and wait until it is ready
+
+    With data_dir, outputs and jobs go there instead of the real store.
+    """
+    env = dict(os.environ)
+    if data_dir:
+        env['PHARMACARE_OUTPUT_DIR'] = os.path.join(data_dir, 'forms')
+        env['PHARMACARE_JOB_DB'] = os.path.join(data_dir, 'jobs.sqlite3')
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, 'json_rpc_server.py'), '--port', str(port),
+         *extra_args],
+        cwd=HERE, env=env, stderr=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + startup_timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("Local server exited during startup")
+        if server_ready('localhost', port):
+            return process
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("Local server did not start in time")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the PharmaCare JSON-RPC server")
+    parser.add_argument('--requests-file', default=os.path.join(HERE, 'requests.jsonl'),
+                        help="JSONL file of requests to replay")
+    parser.add_argument('--synthetic', action='store_true',
+                        help="Send synthetic variants instead of the file as-is")
+    parser.add_argument('--count', type=int, default=100, help="Total requests to send")
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=0,
+                        help="Open-loop arrival rate in batches/second (0 = closed loop)")
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help="Requests per JSON-RPC batch")
+    parser.add_argument('--timeout', type=float, default=30.0, help="Per-call timeout in seconds (the server deadline is capped at 120)")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--start-server', action='store_true',
+                        help="Start a local server on a free port for the run")
+    parser.add_argument('--asyncio', action='store_true',
+                        help="Start the local server with its asyncio front end")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--json', action='store_true', help="Print the report as JSON")
+    args = parser.parse_args()
+
+    base = load_requests(args.requests_file) if os.path.exists(args.requests_file) else None
+    if args.synthetic or not base:
+        requests = synthetic_requests(args.count, base, args.seed)
+    else:
+        requests = base
+
+    host, port = 'localhost', args.port
+    process = None
+    data_dir = None
+    if args.start_server:
+        # Keep synthetic patients out of the real output store and job queue
+        data_dir = tempfile.mkdtemp(prefix='pharmacare-load-')
+        port = free_port()
+        try:
+            process = start_local_server(port, extra_args=['--asyncio'] if args.asyncio else [],
+                                         data_dir=data_dir)
+        except RuntimeError:
+            shutil.rmtree(data_dir, ignore_errors=True)
+            raise
+
+    try:
+        recorder = Recorder()
+        batches = make_batches(requests, args.count, max(1, args.batch_size))
+        before = server_stats(host, port)
+        started = time.perf_counter()
+        if args.rate > 0:
+            run_open_loop(host, port, batches, args.rate, args.concurrency,
+                          args.timeout, recorder, args.seed)
+        else:
+            run_closed_loop(host, port, batches, args.concurrency, args.timeout, recorder)
+        elapsed = time.perf_counter() - started
+        after = server_stats(host, port)
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+        if data_dir:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    report = build_report(recorder, elapsed, before, after)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    return 1 if report['error_rate'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
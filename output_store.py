@@ -0,0 +1,432 @@
+#!/usr/bin/env python3
+"""
+Output Store for Filled Forms
+Filled PDFs are sharded by date and patient:
+
+    <root>/YYYY/MM/DD/<patient_key>/<patient_key>_<YYYYmmdd_HHMMSS>_<suffix>.pdf
+
+Each day directory holds an index.jsonl with one line per output, used
+for lookups by id, and <root>/patients/<patient_key>.jsonl lists every
+output of one patient, so neither lookup lists or scans PDF directories.
+Files are written to a temp name and renamed into place, so readers
+never see a partial PDF. Retention works on whole day directories,
+which are archived to zip files or deleted in bulk.
+
+In overlay mode only the fill data is stored, as a small .json file next
+to where the PDF would be, together with the template version it was
+filled against. Each template version's blank PDF and mapping are kept
+once under <root>/templates/, and full PDFs are rendered again on demand.
+"""
+
+import os
+import re
+import sys
+import json
+import glob
+import shutil
+import secrets
+import argparse
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+DEFAULT_OUTPUT_DIR = os.environ.get('PHARMACARE_OUTPUT_DIR', r"C:\forms")
+DEFAULT_STORAGE_MODE = os.environ.get('PHARMACARE_STORAGE_MODE', 'pdf')
+STORAGE_MODES = ('pdf', 'overlay')
+INDEX_FILENAME = 'index.jsonl'
+TEMPLATES_DIRNAME = 'templates'
+PATIENTS_DIRNAME = 'patients'
+INDEX_LOCK_FILENAME = '.index.lock'
+MATERIALIZE_CACHE_SIZE = 32
+
+_UNSAFE_CHARS = re.compile(r"[^A-Za-z0-9_-]")
+_OUTPUT_ID = re.compile(r"^(\d{4})(\d{2})(\d{2})_\d{6}_[0-9a-f]{8}$")
+
+
+def patient_key(patient_name):
+    """Filesystem-safe key for a patient name, e.g. 'Smith, John' -> 'Smith_John'"""
+    key = _UNSAFE_CHARS.sub('', str(patient_name).replace(' ', '_'))
+    return key[:80] or 'Unknown'
+
+
+def atomic_write(path, data):
+    """Write bytes to path via a temp file and rename, so it appears whole"""
+    tmp_path = f"{path}.tmp-{os.getpid()}-{secrets.token_hex(4)}"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def pdf_bytes(doc, no_new_id=False):
+    """Serialize a filled document, embedding only the glyphs it uses
+
+    Without subsetting, one character outside Helvetica embeds the whole
+    fallback font (over 1.5 MB). no_new_id keeps the trailer /ID, so the
+    same input always gives the same bytes.
+    """
+    doc.subset_fonts()
+    return doc.tobytes(garbage=1, deflate=True, no_new_id=no_new_id)
+
+
+class OutputStore:
+    """Sharded, indexed storage for filled forms"""
+
+    def __init__(self, root=None, mode=None):
+        self.root = root or DEFAULT_OUTPUT_DIR
+        self.mode = mode or DEFAULT_STORAGE_MODE
+        if self.mode not in STORAGE_MODES:
+            raise ValueError(f"Unknown storage mode: {self.mode}")
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        # MuPDF documents must not be rendered from several threads at once
+        self._render_lock = threading.Lock()
+        self._fillers = {}
+
+    def _day_dir(self, output_id):
+        match = _OUTPUT_ID.match(output_id)
+        if not match:
+            raise ValueError(f"Invalid output id: {output_id}")
+        return os.path.join(self.root, *match.groups())
+
+    def full_path(self, record):
+        """Absolute path of a stored output"""
+        path = os.path.join(self.root, record['path'])
+        if os.path.commonpath([os.path.abspath(path), os.path.abspath(self.root)]) \
+                != os.path.abspath(self.root):
+            raise ValueError(f"Output path escapes the store: {record['path']}")
+        return path
+
+    def save(self, doc, patient_name, now=None):
+        """Store a filled document and return its index record"""
+        return self._store('pdf', pdf_bytes(doc), patient_name, now)
+
+    def save_overlay(self, data, patient_name, template_version, template_path, mapping,
+                     now=None):
+        """Store only the fill data and template version; return the index record"""
+        self._ensure_template(template_version, template_path, mapping)
+        body = json.dumps({"template": template_version, "params": data},
+                          sort_keys=True).encode('utf-8')
+        return self._store('overlay', body, patient_name, now, template_version)
+
+    def _store(self, kind, body, patient_name, now, template_version=None):
+        now = now or datetime.now()
+        output_id = f"{now:%Y%m%d_%H%M%S}_{secrets.token_hex(4)}"
+        key = patient_key(patient_name)
+
+        patient_dir = os.path.join(self._day_dir(output_id), key)
+        os.makedirs(patient_dir, exist_ok=True)
+        filename = f"{key}_{output_id}.{'pdf' if kind == 'pdf' else 'json'}"
+        atomic_write(os.path.join(patient_dir, filename), body)
+
+        record = {
+            "id": output_id,
+            "kind": kind,
+            "patient_key": key,
+            "path": os.path.relpath(os.path.join(patient_dir, filename), self.root),
+            "created": now.isoformat(timespec='seconds'),
+        }
+        if template_version:
+            record["template"] = template_version
+        self._append_index(output_id, record)
+        return record
+
+    def _template_dir(self, template_version):
+        return os.path.join(self.root, TEMPLATES_DIRNAME, template_version)
+
+    def _ensure_template(self, template_version, template_path, mapping):
+        """Snapshot a template version once so old records stay reproducible"""
+        template_dir = self._template_dir(template_version)
+        if os.path.exists(os.path.join(template_dir, 'mapping.json')):
+            return
+        os.makedirs(template_dir, exist_ok=True)
+        with open(template_path, 'rb') as f:
+            atomic_write(os.path.join(template_dir, 'template.pdf'), f.read())
+        # mapping.json is written last and marks the snapshot as complete
+        atomic_write(os.path.join(template_dir, 'mapping.json'),
+                     json.dumps(mapping, indent=2).encode('utf-8'))
+
+    def materialize(self, output_id, render=None):
+        """Full PDF bytes for an output id, rendering overlay records on demand
+
+        Recently rendered overlays are kept in a small LRU cache. On a cache
+        miss, render(output_id) is called to produce the bytes, e.g. in a
+        worker process; by default render_overlay() runs in this process.
+        Raises KeyError if the id is unknown.
+        """
+        record = self.lookup(output_id)
+        if record is None:
+            raise KeyError(output_id)
+        if record.get('kind', 'pdf') == 'pdf':
+            with open(self.full_path(record), 'rb') as f:
+                return f.read()
+
+        with self._cache_lock:
+            if output_id in self._cache:
+                self._cache.move_to_end(output_id)
+                return self._cache[output_id]
+
+        data = (render or self.render_overlay)(output_id)
+        with self._cache_lock:
+            self._cache[output_id] = data
+            while len(self._cache) > MATERIALIZE_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return data
+
+    def render_overlay(self, output_id, deadline=None):
+        """Render an overlay record to PDF bytes, bypassing the cache
+
+        Raises KeyError if the id is unknown, and DeadlineExceeded once the
+        optional time.monotonic() deadline has passed.
+        """
+        record = self.lookup(output_id)
+        if record is None or record.get('kind') != 'overlay':
+            raise KeyError(output_id)
+        with open(self.full_path(record), 'r', encoding='utf-8') as f:
+            overlay = json.load(f)
+        template_path = os.path.join(self._template_dir(overlay['template']), 'template.pdf')
+        with self._render_lock:
+            filler = self._filler_for(overlay['template'])
+            with filler.render(overlay['params'], deadline, template_path) as doc:
+                # Byte-identical on every render: downloads use a strong ETag
+                # and may resume with Range after a cache eviction
+                return pdf_bytes(doc, no_new_id=True)
+
+    def _filler_for(self, template_version):
+        """A filler using the mapping snapshot of the given template version"""
+        filler = self._fillers.get(template_version)
+        if filler is None:
+            from enhanced_pdf_filler_v2 import EnhancedPDFFiller
+            with open(os.path.join(self._template_dir(template_version), 'mapping.json'),
+                      'r', encoding='utf-8') as f:
+                mapping = json.load(f)
+            filler = self._fillers[template_version] = EnhancedPDFFiller(mapping, store=self)
+        return filler
+
+    def export(self, dest_dir, since=None, until=None, patient_name=None):
+        """Write full PDFs for every output in a date range to dest_dir
+
+        since and until are inclusive datetime.date bounds. Returns the
+        number of files written.
+        """
+        os.makedirs(dest_dir, exist_ok=True)
+        key = patient_key(patient_name) if patient_name else None
+        written = 0
+        for index_path in self._day_indexes():
+            day_dir = os.path.dirname(index_path)
+            month_dir, day = os.path.split(day_dir)
+            year_dir, month = os.path.split(month_dir)
+            shard_date = datetime(int(os.path.basename(year_dir)), int(month), int(day)).date()
+            if (since and shard_date < since) or (until and shard_date > until):
+                continue
+            for record in self._read_index(index_path):
+                if key and record['patient_key'] != key:
+                    continue
+                filename = f"{record['patient_key']}_{record['id']}.pdf"
+                atomic_write(os.path.join(dest_dir, filename), self.materialize(record['id']))
+                written += 1
+        return written
+
+    def _append_index(self, output_id, record):
+        """Add a record to its day index and to its patient's index"""
+        os.makedirs(os.path.join(self.root, PATIENTS_DIRNAME), exist_ok=True)
+        with self._index_lock():
+            self._append_records(os.path.join(self._day_dir(output_id), INDEX_FILENAME),
+                                 [record])
+            self._append_records(self._patient_index(record['patient_key']), [record])
+
+    @contextmanager
+    def _index_lock(self):
+        """Hold the store-wide lock that serializes index writes across processes
+
+        O_APPEND alone is not enough: on Windows it is a seek to the end
+        followed by a write, so concurrent appends can overwrite each other.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        fd = os.open(os.path.join(self.root, INDEX_LOCK_FILENAME), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if fcntl:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            else:
+                # Retries for about 10 seconds before raising OSError
+                msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                else:
+                    os.lseek(fd, 0, os.SEEK_SET)
+                    msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        finally:
+            os.close(fd)
+
+    def _append_records(self, index_path, records):
+        # Callers hold _index_lock(); one write per call keeps lines whole
+        data = ''.join(json.dumps(record) + '\n' for record in records).encode('utf-8')
+        fd = os.open(index_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+    def _patient_index(self, key):
+        return os.path.join(self.root, PATIENTS_DIRNAME, f"{key}.jsonl")
+
+    def _read_index(self, index_path):
+        records = []
+        try:
+            with open(index_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        records.append(json.loads(line))
+        except FileNotFoundError:
+            pass
+        return records
+
+    def _day_indexes(self):
+        return sorted(glob.glob(os.path.join(self.root, '[0-9]' * 4, '[0-9]' * 2,
+                                             '[0-9]' * 2, INDEX_FILENAME)))
+
+    def lookup(self, output_id):
+        """Index record for an output id, or None"""
+        try:
+            index_path = os.path.join(self._day_dir(output_id), INDEX_FILENAME)
+        except ValueError:
+            return None
+        for record in self._read_index(index_path):
+            if record['id'] == output_id:
+                return record
+        return None
+
+    def find_by_patient(self, patient_name):
+        """All records for a patient, newest first"""
+        records = self._read_index(self._patient_index(patient_key(patient_name)))
+        return sorted(reversed(records), key=lambda record: record['created'], reverse=True)
+
+    def rebuild_patient_indexes(self):
+        """Recreate the per-patient indexes from the day indexes
+
+        For stores written before per-patient indexes existed. Returns the
+        number of patients indexed.
+        """
+        by_patient = {}
+        for index_path in self._day_indexes():
+            for record in self._read_index(index_path):
+                by_patient.setdefault(record['patient_key'], []).append(record)
+        patients_dir = os.path.join(self.root, PATIENTS_DIRNAME)
+        with self._index_lock():
+            shutil.rmtree(patients_dir, ignore_errors=True)
+            os.makedirs(patients_dir)
+            for key, records in by_patient.items():
+                atomic_write(self._patient_index(key), ''.join(
+                    json.dumps(record) + '\n' for record in records).encode('utf-8'))
+        return len(by_patient)
+
+    def compact(self, max_age_days, archive_dir=None, now=None):
+        """Archive (zip) or delete whole day shards older than max_age_days
+
+        Returns the list of day shards removed, as YYYY-MM-DD strings.
+        """
+        cutoff = (now or datetime.now()).date() - timedelta(days=max_age_days)
+        removed = []
+        removed_ids = {}
+        for index_dir in sorted(glob.glob(os.path.join(self.root, '[0-9]' * 4,
+                                                       '[0-9]' * 2, '[0-9]' * 2))):
+            month_dir, day = os.path.split(index_dir)
+            year_dir, month = os.path.split(month_dir)
+            year = os.path.basename(year_dir)
+            try:
+                shard_date = datetime(int(year), int(month), int(day)).date()
+            except ValueError:
+                continue
+            if shard_date >= cutoff:
+                continue
+
+            shard_name = shard_date.isoformat()
+            for record in self._read_index(os.path.join(index_dir, INDEX_FILENAME)):
+                removed_ids.setdefault(record['patient_key'], set()).add(record['id'])
+            if archive_dir:
+                os.makedirs(archive_dir, exist_ok=True)
+                shutil.make_archive(os.path.join(archive_dir, shard_name), 'zip', index_dir)
+            shutil.rmtree(index_dir)
+            removed.append(shard_name)
+
+            # Drop month/year directories left empty
+            for parent in (month_dir, year_dir):
+                if not os.listdir(parent):
+                    os.rmdir(parent)
+
+        self._prune_patient_indexes(removed_ids)
+        return removed
+
+    def _prune_patient_indexes(self, removed_ids):
+        """Drop records of removed day shards from the per-patient indexes"""
+        with self._index_lock():
+            for key, ids in removed_ids.items():
+                path = self._patient_index(key)
+                records = self._read_index(path)
+                kept = [record for record in records if record['id'] not in ids]
+                if len(kept) == len(records):
+                    continue
+                if kept:
+                    atomic_write(path, ''.join(
+                        json.dumps(record) + '\n' for record in kept).encode('utf-8'))
+                else:
+                    os.remove(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage stored PharmaCare form outputs")
+    parser.add_argument('--root', default=DEFAULT_OUTPUT_DIR, help="Output store directory")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    compact = commands.add_parser('compact', help="Archive or delete old outputs")
+    compact.add_argument('--max-age-days', type=int, required=True)
+    compact.add_argument('--archive', help="Zip old day shards here instead of only deleting")
+
+    find = commands.add_parser('find', help="List outputs for a patient")
+    find.add_argument('patient_name')
+
+    commands.add_parser('reindex', help="Rebuild the per-patient indexes from the day indexes")
+
+    export = commands.add_parser('export', help="Write full PDFs for a date range")
+    export.add_argument('--dest', required=True)
+    export.add_argument('--since', help="First day to export, YYYY-MM-DD")
+    export.add_argument('--until', help="Last day to export, YYYY-MM-DD")
+    export.add_argument('--patient', help="Only export this patient's outputs")
+
+    args = parser.parse_args()
+    store = OutputStore(args.root)
+    if args.command == 'compact':
+        removed = store.compact(args.max_age_days, args.archive)
+        print(f"Removed {len(removed)} day shards: {', '.join(removed)}")
+    elif args.command == 'find':
+        for record in store.find_by_patient(args.patient_name):
+            print(f"{record['created']}  {record['id']}  {store.full_path(record)}")
+    elif args.command == 'reindex':
+        print(f"Indexed {store.rebuild_patient_indexes()} patients")
+    elif args.command == 'export':
+        since = datetime.strptime(args.since, '%Y-%m-%d').date() if args.since else None
+        until = datetime.strptime(args.until, '%Y-%m-%d').date() if args.until else None
+        written = store.export(args.dest, since, until, args.patient)
+        print(f"Exported {written} forms to {args.dest}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+"""
+Worker Pool for PDF Form Filling
+Runs fills, and renders of stored overlay records, in separate processes
+so MuPDF memory is returned to the OS when a worker is recycled. Each worker loads the mapping, template and
+fonts and renders a throwaway fill before it takes any requests.
+
+A worker retires itself after a number of requests, above an RSS
+threshold, or if it still holds open documents after a request. It
+always answers its current request first, so recycling never drops
+in-flight work, and its successor is warmed up before taking traffic.
+"""
+
+import os
+import sys
+import time
+import queue
+import logging
+import threading
+import multiprocessing
+
+from enhanced_pdf_filler_v2 import (
+    DeadlineExceeded, handle_pdf_request, open_document_count, get_filler
+)
+
+# Extra time given to a worker past the request deadline before it is killed
+KILL_GRACE_SECONDS = 5.0
+# How long a new worker may take to import, load and warm up
+STARTUP_TIMEOUT_SECONDS = 60.0
+# How often a request waiting for a worker checks whether it was cancelled
+CANCEL_POLL_SECONDS = 0.1
+
+
+class RequestCancelled(Exception):
+    """The caller gave up on a fill before a worker picked it up"""
+
+
+class WorkerUnavailable(DeadlineExceeded):
+    """The deadline passed before any worker was free; nothing was run"""
+
+
+def current_rss():
+    """Resident set size of this process in bytes, or None if unknown
+
+    Uses psutil when it is installed, else the OS directly: the working
+    set on Windows, /proc on Linux.
+    """
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    if sys.platform == 'win32':
+        return _windows_rss()
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _windows_rss():
+    """Working set size from GetProcessMemoryInfo, or None if the call fails"""
+    import ctypes
+    from ctypes import wintypes
+
+    class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+        _fields_ = [
+            ("cb", wintypes.DWORD),
+            ("PageFaultCount", wintypes.DWORD),
+            ("PeakWorkingSetSize", ctypes.c_size_t),
+            ("WorkingSetSize", ctypes.c_size_t),
+            ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+            ("PagefileUsage", ctypes.c_size_t),
+            ("PeakPagefileUsage", ctypes.c_size_t),
+        ]
+
+    try:
+        kernel32 = ctypes.WinDLL('kernel32')
+        psapi = ctypes.WinDLL('psapi')
+    except OSError:
+        return None
+    kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+    psapi.GetProcessMemoryInfo.argtypes = [
+        wintypes.HANDLE, ctypes.POINTER(PROCESS_MEMORY_COUNTERS), wintypes.DWORD]
+    psapi.GetProcessMemoryInfo.restype = wintypes.BOOL
+    counters = PROCESS_MEMORY_COUNTERS()
+    counters.cb = ctypes.sizeof(counters)
+    if not psapi.GetProcessMemoryInfo(kernel32.GetCurrentProcess(), ctypes.byref(counters),
+                                      counters.cb):
+        return None
+    return counters.WorkingSetSize
+
+
+def _worker_main(conn, max_requests, max_rss_bytes):
+    """Worker process loop: warm up, then fill requests until told to stop or retiring"""
+    started = time.perf_counter()
+    try:
+        get_filler().warm_up()
+    except Exception as e:
+        conn.send(('failed', str(e)))
+        conn.close()
+        return
+    times = os.times()
+    conn.send(('ready', {
+        "startup_seconds": time.perf_counter() - started,
+        "rss_bytes": current_rss(),
+        "cpu_user_seconds": times.user,
+        "cpu_system_seconds": times.system,
+    }))
+
+    served = 0
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+
+        kind, data, timeout, profile_options = message
+        deadline = time.monotonic() + timeout
+        if kind == 'render':
+            status, payload = _run_render(data, deadline)
+            profile = None
+        elif profile_options is None:
+            status, payload = _run_fill(data, deadline)
+            profile = None
+        else:
+            status, payload, profile = _run_profiled(data, deadline, profile_options)
+
+        served += 1
+        times = os.times()
+        rss = current_rss()
+        open_docs = open_document_count()
+        retiring = (
+            served >= max_requests
+            or bool(max_rss_bytes and rss and rss > max_rss_bytes)
+            or open_docs > 0
+        )
+        conn.send((status, payload, profile, {
+            "pid": os.getpid(),
+            "requests": served,
+            "rss_bytes": rss,
+            "cpu_user_seconds": times.user,
+            "cpu_system_seconds": times.system,
+            "open_documents": open_docs,
+            "retiring": retiring,
+        }))
+        if retiring:
+            break
+    conn.close()
+
+
+def _run_fill(params, deadline):
+    try:
+        return 'ok', handle_pdf_request(params, deadline=deadline)
+    except DeadlineExceeded as e:
+        return 'timeout', str(e)
+    except Exception as e:
+        return 'error', str(e)
+
+
+def _run_render(output_id, deadline):
+    try:
+        return 'ok', get_filler().store.render_overlay(output_id, deadline)
+    except DeadlineExceeded as e:
+        return 'timeout', str(e)
+    except KeyError:
+        return 'error', f"Unknown overlay record: {output_id}"
+    except Exception as e:
+        return 'error', str(e)
+
+
+def _run_profiled(params, deadline, options):
+    """Run one fill under cProfile and/or tracemalloc, collecting field timings
+
+    The cProfile data is dumped to a file in options['dir']; memory and
+    field timings are returned directly.
+    """
+    import cProfile
+    import tracemalloc
+
+    filler = get_filler()
+    filler.field_timings = {}
+    profiler = cProfile.Profile() if options.get('cpu') else None
+    snapshot = None
+    if options.get('memory'):
+        tracemalloc.start()
+    if profiler:
+        profiler.enable()
+    try:
+        status, payload = _run_fill(params, deadline)
+    finally:
+        # Snapshot before the profiler is stopped or dumped, so its own
+        # allocations are not reported as the fill's
+        if options.get('memory'):
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+        if profiler:
+            profiler.disable()
+        field_timings, filler.field_timings = filler.field_timings, None
+
+    profile = {"field_seconds": field_timings}
+    if profiler:
+        path = os.path.join(options['dir'], f"worker-{os.getpid()}-{time.time_ns()}.prof")
+        profiler.dump_stats(path)
+        profile["cpu_file"] = path
+    if snapshot is not None:
+        snapshot = snapshot.filter_traces([
+            tracemalloc.Filter(False, cProfile.__file__),
+            tracemalloc.Filter(False, tracemalloc.__file__),
+        ])
+        profile["allocations"] = [
+            (str(stat.traceback[0]), stat.size, stat.count)
+            for stat in snapshot.statistics('lineno')[:options.get('top', 20)]
+        ]
+    return status, payload, profile
+
+
+class _Worker:
+    """One worker process and the parent end of its pipe"""
+
+    def __init__(self, context, max_requests, max_rss_bytes):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main,
+            args=(child_conn, max_requests, max_rss_bytes),
+            daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        self.stats = {"pid": self.process.pid, "requests": 0}
+
+    def wait_ready(self, timeout=STARTUP_TIMEOUT_SECONDS):
+        """Block until the worker has warmed up; returns its startup seconds"""
+        try:
+            if not self.conn.poll(timeout):
+                raise RuntimeError("Worker did not warm up in time")
+            status, payload = self.conn.recv()
+        except (EOFError, RuntimeError):
+            self.kill()
+            raise RuntimeError("Worker failed to start")
+        if status != 'ready':
+            self.kill()
+            raise RuntimeError(f"Worker warm-up failed: {payload}")
+        self.stats.update(payload, startup_seconds=round(payload["startup_seconds"], 3))
+        return payload["startup_seconds"]
+
+    def run(self, kind, data, deadline, profile_options=None):
+        """Send one 'fill' or 'render' request and wait for its reply; returns (result, profile)"""
+        timeout = max(0.0, deadline - time.monotonic())
+        self.conn.send((kind, data, timeout, profile_options))
+        if not self.conn.poll(timeout + KILL_GRACE_SECONDS):
+            self.kill()
+            raise DeadlineExceeded("Request deadline exceeded")
+        try:
+            status, payload, profile, self.stats = self.conn.recv()
+        except EOFError:
+            raise RuntimeError("Worker exited unexpectedly")
+        if status == 'timeout':
+            raise DeadlineExceeded(payload)
+        if status == 'error':
+            raise RuntimeError(payload)
+        return payload, profile
+
+    @property
+    def reusable(self):
+        return self.process.is_alive() and not self.stats.get('retiring')
+
+    def stop(self, timeout=5.0):
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.kill()
+        self.conn.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+
+
+class WorkerPool:
+    """Fixed-size pool of recyclable fill worker processes"""
+
+    def __init__(self, size=2, max_requests=500, max_rss_mb=400):
+        self.size = size
+        self.max_requests = max_requests
+        self.max_rss_bytes = max_rss_mb * 1024 * 1024 if max_rss_mb else None
+        self.context = multiprocessing.get_context('spawn')
+        self.idle = queue.Queue()
+        self.lock = threading.Lock()
+        self.workers = set()
+        self.recycled = 0
+        # CPU seconds (user, system) used by workers that have exited
+        self.retired_cpu = [0.0, 0.0]
+        self.closed = False
+        self.logger = logging.getLogger(__name__)
+
+    def start(self):
+        """Start and warm up all workers; returns the slowest startup in seconds"""
+        workers = [self._spawn() for _ in range(self.size)]
+        startup = max(worker.wait_ready() for worker in workers)
+        if self.max_rss_bytes and any(w.stats.get('rss_bytes') is None for w in workers):
+            self.logger.warning("Worker memory cannot be measured on this system, so "
+                                "the worker RSS limit is not enforced; install psutil")
+        for worker in workers:
+            self.idle.put(worker)
+        return startup
+
+    def _spawn(self):
+        worker = _Worker(self.context, self.max_requests, self.max_rss_bytes)
+        with self.lock:
+            self.workers.add(worker)
+        return worker
+
+    def _replace(self, worker):
+        """Retire a worker and start its successor in the background"""
+        worker.stop()
+        with self.lock:
+            self.workers.discard(worker)
+            self._add_retired_cpu(worker)
+            self.recycled += 1
+        self.logger.info(f"Recycled worker {worker.stats.get('pid')} "
+                         f"after {worker.stats.get('requests')} requests, "
+                         f"RSS {worker.stats.get('rss_bytes')} bytes")
+        while not self.closed:
+            successor = self._spawn()
+            try:
+                successor.wait_ready()
+            except RuntimeError as e:
+                with self.lock:
+                    self.workers.discard(successor)
+                self.logger.error(f"Replacement worker failed, retrying: {e}")
+                time.sleep(1.0)
+                continue
+            self.idle.put(successor)
+            break
+
+    def submit(self, params, deadline, profile=None, cancelled=None):
+        """Run one fill on an idle worker, waiting for one until the deadline
+
+        profile is an optional profiling session; its options are sent with
+        the job and profile.record() is always called once with the worker's
+        measurements, or None if the fill did not complete.
+
+        cancelled is an optional threading.Event. If it is set while the
+        fill is still waiting for a worker, RequestCancelled is raised; a
+        fill that has already started always runs to completion.
+        """
+        measurements = None
+        try:
+            result, measurements = self._run(
+                'fill', params, deadline, profile.options if profile else None, cancelled)
+            return result
+        finally:
+            if profile is not None:
+                profile.record(measurements)
+
+    def render(self, output_id, deadline):
+        """Render a stored overlay record to PDF bytes on an idle worker
+
+        Waits for a worker until the deadline, like submit(), so on-demand
+        renders get the same memory isolation and recycling as fills.
+        """
+        result, _ = self._run('render', output_id, deadline, None, None)
+        return result
+
+    def _acquire(self, deadline, cancelled):
+        """Take an idle worker, giving up at the deadline or once cancelled"""
+        while True:
+            remaining = deadline - time.monotonic()
+            if cancelled is not None:
+                if cancelled.is_set():
+                    raise RequestCancelled("Request cancelled before a worker picked it up")
+                remaining = min(remaining, CANCEL_POLL_SECONDS)
+            try:
+                return self.idle.get(timeout=max(0.0, remaining))
+            except queue.Empty:
+                if time.monotonic() >= deadline:
+                    raise WorkerUnavailable("No worker became available before the deadline")
+
+    def _run(self, kind, data, deadline, profile_options, cancelled):
+        worker = self._acquire(deadline, cancelled)
+        try:
+            return worker.run(kind, data, deadline, profile_options)
+        finally:
+            if worker.reusable and not self.closed:
+                self.idle.put(worker)
+            elif self.closed:
+                self._retire(worker)
+            else:
+                threading.Thread(target=self._replace, args=(worker,), daemon=True).start()
+
+    def _retire(self, worker):
+        worker.stop()
+        with self.lock:
+            self.workers.discard(worker)
+            self._add_retired_cpu(worker)
+
+    def _add_retired_cpu(self, worker):
+        self.retired_cpu[0] += worker.stats.get('cpu_user_seconds', 0.0)
+        self.retired_cpu[1] += worker.stats.get('cpu_system_seconds', 0.0)
+
+    def snapshot(self):
+        """Latest per-worker stats for getServerStats
+
+        CPU totals cover every worker this pool has run, including retired
+        ones, as of each worker's last completed request.
+        """
+        with self.lock:
+            workers = [dict(worker.stats) for worker in self.workers]
+            return {
+                "size": self.size,
+                "recycled": self.recycled,
+                "cpu_user_seconds": self.retired_cpu[0] + sum(
+                    w.get('cpu_user_seconds', 0.0) for w in workers),
+                "cpu_system_seconds": self.retired_cpu[1] + sum(
+                    w.get('cpu_system_seconds', 0.0) for w in workers),
+                "workers": workers,
+            }
+
+    def close(self):
+        """Stop idle workers now; busy ones stop after their current request"""
+        self.closed = True
+        while True:
+            try:
+                worker = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            self._retire(worker)